@@ -0,0 +1,300 @@
+"""Latency benchmarks for Mercury's hot paths. Run `python3 benchmark.py -h` to see the options."""
+
+import random
+import time
+from typing import Callable, List
+
+import numpy as np
+
+from database import Database
+
+
+def report(name: str, latencies: List[float]):
+    latencies_ms = np.array(latencies) * 1000
+    print(
+        f"{name:<16} n={len(latencies_ms):<6} "
+        f"p50={np.percentile(latencies_ms, 50):8.3f} ms  "
+        f"p99={np.percentile(latencies_ms, 99):8.3f} ms  "
+        f"mean={latencies_ms.mean():8.3f} ms"
+    )
+
+
+def time_calls(func: Callable, args_list: list) -> List[float]:
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def sample_queries(database: Database, num_queries: int, seed: int = 0) -> list:
+    """Pick random ingested chunks as selection queries: (sample_id, opposite text_type, embedding)."""
+    from search import fetch_chunk_embedding
+
+    random.seed(seed)
+    max_chunk_id = database.read_db.execute("SELECT MAX(chunk_id) FROM chunks").fetchone()[0]
+    queries = []
+    while len(queries) < num_queries:
+        chunk_id = random.randint(0, max_chunk_id)
+        row = database.read_db.execute("SELECT sample_id, text_type FROM chunks WHERE chunk_id = ?", [chunk_id]).fetchone()
+        embedding = fetch_chunk_embedding(database.read_db, chunk_id)
+        if row is None or embedding is None:
+            continue
+        sample_id, text_type = row
+        queries.append((sample_id, "source" if text_type == "summary" else "summary", embedding))
+    return queries
+
+
+def bench_search(args):
+    from search import SEARCH_BACKENDS
+
+    database = Database(args.sqlite_db)
+    queries = sample_queries(database, args.num_queries)
+    for name, backend_class in SEARCH_BACKENDS.items():
+        backend = backend_class(database)
+        report(name, time_calls(backend.search, queries))
+        if name == "numpy":  # second pass with every sample already loaded in memory
+            report("numpy (warm)", time_calls(backend.search, queries))
+
+
+def bench_quantized(args):
+    from search import SqliteVecSearch
+
+    database = Database(args.sqlite_db)
+    quantization = database.fetch_configs().get("quantization", "none")
+    if quantization == "none":
+        raise SystemExit(f"{args.sqlite_db} has no quantized embeddings. Ingest with --quantization int8 or binary.")
+    queries = sample_queries(database, args.num_queries)
+    full_precision = SqliteVecSearch(database)
+    quantized = SqliteVecSearch(database, quantization=quantization, rescore_factor=args.rescore_factor)
+    report("float32", time_calls(full_precision.search, queries))
+    report(f"{quantization}+rescore", time_calls(quantized.search, queries))
+
+    recalls = []
+    for query in queries:
+        expected = {result.chunk_id for result in full_precision.search(*query)}
+        found = {result.chunk_id for result in quantized.search(*query)}
+        if len(expected) > 0:
+            recalls.append(len(expected & found) / len(expected))
+    print(f"recall@5 of {quantization}+rescore against float32: {np.mean(recalls):.4f}")
+
+
+def serve_openai_stub(port: int, dimension: int, rate_limit_every: int) -> "ThreadingHTTPServer":
+    """Start a local server mimicking OpenAI's /v1/embeddings endpoint in a background thread.
+
+    Embeddings are derived from the input text, so callers can check that order is preserved.
+    Every `rate_limit_every`-th request is answered with a 429 to exercise the client's backoff.
+    """
+    import base64
+    import hashlib
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    counter = {"requests": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            counter["requests"] += 1
+            if rate_limit_every > 0 and counter["requests"] % rate_limit_every == 0:
+                self.send_response(429)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Retry-After", "0.1")
+                self.end_headers()
+                self.wfile.write(json.dumps({"error": {"message": "Rate limit reached", "type": "rate_limit_error"}}).encode())
+                return
+            data = []
+            for i, text in enumerate(body["input"]):
+                embedding = stub_embedding(text, body.get("dimensions", dimension))
+                if body.get("encoding_format") == "base64":
+                    embedding = base64.b64encode(embedding.astype("<f4").tobytes()).decode()
+                else:
+                    embedding = embedding.tolist()
+                data.append({"object": "embedding", "index": i, "embedding": embedding})
+            tokens = sum(len(text) // 4 + 1 for text in body["input"])
+            payload = {"object": "list", "data": data, "model": body["model"], "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(payload).encode())
+
+    def stub_embedding(text: str, dimension: int) -> np.ndarray:
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:4], "little")
+        embedding = np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+        return embedding / np.linalg.norm(embedding)
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.stub_embedding = stub_embedding
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_openai(args):
+    import os
+
+    from embedding import OpenAIEmbeddingClient
+
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    server = serve_openai_stub(args.port, args.dimension, args.rate_limit_every)
+    texts = [f"Sentence number {i} of the benchmark." for i in range(args.num_texts)]
+    client = OpenAIEmbeddingClient(
+        "text-embedding-3-small",
+        max_concurrency=args.max_concurrency,
+        max_items=args.max_items,
+        base_url=f"http://127.0.0.1:{args.port}/v1",
+    )
+    start = time.perf_counter()
+    embeddings = client.embed(texts, dimensions=args.dimension)
+    elapsed = time.perf_counter() - start
+    expected = np.stack([server.stub_embedding(text, args.dimension) for text in texts])
+    print(f"Embedded {len(texts)} texts in {len(client.pack(texts))} requests in {elapsed:.2f} s ({len(texts) / elapsed:.0f} texts/s)")
+    print(f"Order preserved: {bool(np.allclose(embeddings, expected, atol=1e-6))}")
+    server.shutdown()
+
+
+def bench_startup(args):
+    """Cold start of `server.py`: time until it answers `/task`, and until `/ready` reports the model loaded."""
+    import subprocess
+    import sys
+    import urllib.error
+    import urllib.request
+
+    def wait_for(url: str, deadline: float) -> float | None:
+        while time.perf_counter() < deadline:
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter()
+            except (urllib.error.URLError, ConnectionError, TimeoutError):
+                pass
+            time.sleep(0.05)
+        return None
+
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import server"], check=True)
+    print(f"import server: {time.perf_counter() - start:.2f} s")
+
+    for run in range(args.runs):
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "server.py", "--sqlite_db", args.sqlite_db, "--port", str(args.port)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            deadline = start + args.timeout
+            serving = wait_for(f"http://127.0.0.1:{args.port}/task", deadline)
+            ready = wait_for(f"http://127.0.0.1:{args.port}/ready", deadline)
+        finally:
+            process.terminate()
+            process.wait()
+        describe = lambda t: "timed out" if t is None else f"{t - start:.2f} s"
+        print(f"run {run}: first response {describe(serving)}, model ready {describe(ready)}")
+
+
+def bench_workers(args):
+    """Request throughput of `server.py --workers N` for several N, with concurrent clients on the read endpoints."""
+    import http.client
+    import subprocess
+    import sys
+    import threading
+
+    database = Database(args.sqlite_db)
+    num_tasks = database.read_db.execute("SELECT MAX(sample_id) + 1 FROM documents").fetchone()[0] or 1
+    paths = [f"/task/{i % num_tasks}" for i in range(args.num_clients * 16)]
+    paths += [f"/task/{i % num_tasks}/history" for i in range(args.num_clients * 16)]
+    paths += [f"/labels?limit=10&after={i % num_tasks}" for i in range(args.num_clients * 4)]
+
+    def wait_until_serving(deadline: float) -> bool:
+        while time.perf_counter() < deadline:
+            try:
+                connection = http.client.HTTPConnection("127.0.0.1", args.port, timeout=1)
+                connection.request("GET", "/task")
+                if connection.getresponse().status == 200:
+                    return True
+            except OSError:
+                pass
+            time.sleep(0.1)
+        return False
+
+    def client(seed: int, stop: float, latencies: List[float]):
+        rng = random.Random(seed)
+        connection = http.client.HTTPConnection("127.0.0.1", args.port, timeout=30)
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            connection.request("GET", rng.choice(paths), headers={"User-Key": "benchmark"})
+            connection.getresponse().read()
+            latencies.append(time.perf_counter() - start)
+
+    for workers in args.workers:
+        process = subprocess.Popen(
+            [sys.executable, "server.py", "--sqlite_db", args.sqlite_db, "--port", str(args.port), "--workers", str(workers)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            if not wait_until_serving(time.perf_counter() + args.timeout):
+                print(f"workers={workers}: the server did not start")
+                continue
+            latencies = [[] for _ in range(args.num_clients)]
+            stop = time.perf_counter() + args.duration
+            threads = [threading.Thread(target=client, args=(i, stop, latencies[i])) for i in range(args.num_clients)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            all_latencies = [latency for client_latencies in latencies for latency in client_latencies]
+            print(f"workers={workers:<3} {len(all_latencies) / args.duration:8.1f} req/s")
+            report(f"workers={workers}", all_latencies)
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    search_parser = subparsers.add_parser("search", help="p50/p99 latency of the selection search backends side by side")
+    search_parser.add_argument("--sqlite_db", type=str, default="./mercury.sqlite")
+    search_parser.add_argument("--num_queries", type=int, default=1000)
+    search_parser.set_defaults(func=bench_search)
+
+    quantized_parser = subparsers.add_parser("quantized", help="Latency and recall of quantized search with rescoring against the float32 baseline")
+    quantized_parser.add_argument("--sqlite_db", type=str, default="./mercury.sqlite")
+    quantized_parser.add_argument("--num_queries", type=int, default=1000)
+    quantized_parser.add_argument("--rescore_factor", type=int, default=4)
+    quantized_parser.set_defaults(func=bench_quantized)
+
+    openai_parser = subparsers.add_parser("openai", help="Throughput of the concurrent OpenAI embedding client against a local stub endpoint")
+    openai_parser.add_argument("--port", type=int, default=8765)
+    openai_parser.add_argument("--num_texts", type=int, default=20000)
+    openai_parser.add_argument("--dimension", type=int, default=256)
+    openai_parser.add_argument("--max_items", type=int, default=256, help="Inputs per request")
+    openai_parser.add_argument("--max_concurrency", type=int, default=8)
+    openai_parser.add_argument("--rate_limit_every", type=int, default=10, help="Answer every n-th request with a 429. 0 disables it")
+    openai_parser.set_defaults(func=bench_openai)
+
+    startup_parser = subparsers.add_parser("startup", help="Cold start time of server.py until it serves requests and until the embedding model is ready")
+    startup_parser.add_argument("--sqlite_db", type=str, default="./mercury.sqlite")
+    startup_parser.add_argument("--port", type=int, default=8766)
+    startup_parser.add_argument("--runs", type=int, default=3)
+    startup_parser.add_argument("--timeout", type=float, default=600, help="Give up on a run after this many seconds")
+    startup_parser.set_defaults(func=bench_startup)
+
+    workers_parser = subparsers.add_parser("workers", help="Request throughput of server.py across worker process counts")
+    workers_parser.add_argument("--sqlite_db", type=str, default="./mercury.sqlite")
+    workers_parser.add_argument("--port", type=int, default=8767)
+    workers_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    workers_parser.add_argument("--num_clients", type=int, default=32, help="Concurrent client connections")
+    workers_parser.add_argument("--duration", type=float, default=10, help="Seconds of load per worker count")
+    workers_parser.add_argument("--timeout", type=float, default=600, help="Give up on a server that does not answer after this many seconds")
+    workers_parser.set_defaults(func=bench_workers)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,9 +1,16 @@
+import hashlib
+import itertools
 import json
+import pathlib
+import queue
+import time
 import uuid
-from typing import List, Literal, TypedDict
-import pandas as pd
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterable, Iterator, List, Literal, TypedDict
 import threading
 import re
+import struct
 
 import sqlite3
 import sqlite_vec
@@ -133,11 +140,271 @@ class AnnotationData(TypedDict):
     #              "source_end", "consistent", "task_index", "user_id"])
     # return annotations
 
+def annotation_hash(sample_id: int, annot_spans: str, annotator: str, label: str, note: str) -> bytes:
+    """Identifies an annotation by its content, so that submitting the same annotation twice stores it once."""
+    return hashlib.sha256(json.dumps([sample_id, annot_spans, annotator, label, note]).encode()).digest()
+
+
+def migrate_v1(db: sqlite3.Connection):
+    """The original schema of the annotation tables."""
+    db.execute("CREATE TABLE IF NOT EXISTS annotations (\
+               annot_id INTEGER PRIMARY KEY AUTOINCREMENT, \
+               sample_id INTEGER, \
+               annot_spans TEXT, \
+               annotator TEXT, \
+               label TEXT, \
+               note TEXT)")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, user_name TEXT)"
+    )
+
+
+def migrate_v2(db: sqlite3.Connection):
+    """Index annotations by annotator and by sample, and dedup them by a unique content hash."""
+    columns = [row[1] for row in db.execute("PRAGMA table_info(annotations)").fetchall()]
+    if "content_hash" not in columns:
+        db.execute("ALTER TABLE annotations ADD COLUMN content_hash BLOB")
+    # older versions let duplicates through when two requests raced past the check. Keep the oldest copy.
+    seen = set()
+    rows = db.execute("SELECT annot_id, sample_id, annot_spans, annotator, label, note FROM annotations ORDER BY annot_id").fetchall()
+    for annot_id, *content in rows:
+        content_hash = annotation_hash(*content)
+        if content_hash in seen:
+            db.execute("DELETE FROM annotations WHERE annot_id = ?", (annot_id,))
+        else:
+            seen.add(content_hash)
+            db.execute("UPDATE annotations SET content_hash = ? WHERE annot_id = ?", (content_hash, annot_id))
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS annotations_content_hash ON annotations (content_hash)")
+    db.execute("CREATE INDEX IF NOT EXISTS annotations_annotator_sample_id ON annotations (annotator, sample_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS annotations_sample_id ON annotations (sample_id)")
+
+
+def migrate_v3(db: sqlite3.Connection):
+    """Count changes to annotations and user names in config's `labels_version`, for the ETag of `/labels`."""
+    db.execute("INSERT OR IGNORE INTO config (key, value) VALUES ('labels_version', '0')")
+    for table in ("annotations", "users"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            db.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_labels_version AFTER {event} ON {table} \
+                  BEGIN UPDATE config SET value = CAST(value AS INTEGER) + 1 WHERE key = 'labels_version'; END"
+            )
+
+
+def migrate_v4(db: sqlite3.Connection):
+    """Log every annotation insert and delete in `annotation_changes`, for consumers that mirror the annotations.
+
+    Triggers write the log in the same transaction as the change. Existing annotations are logged
+    as inserts, so reading the log from the start rebuilds the whole table.
+    """
+    db.execute("CREATE TABLE IF NOT EXISTS annotation_changes (\
+               seq INTEGER PRIMARY KEY AUTOINCREMENT, \
+               op TEXT, \
+               annot_id INTEGER, \
+               sample_id INTEGER, \
+               annot_spans TEXT, \
+               annotator TEXT, \
+               label TEXT, \
+               note TEXT)")
+    db.execute("INSERT INTO annotation_changes (op, annot_id, sample_id, annot_spans, annotator, label, note) \
+               SELECT 'insert', annot_id, sample_id, annot_spans, annotator, label, note FROM annotations ORDER BY annot_id")
+    db.execute("CREATE TRIGGER IF NOT EXISTS annotations_insert_changes AFTER INSERT ON annotations \
+               BEGIN INSERT INTO annotation_changes (op, annot_id, sample_id, annot_spans, annotator, label, note) \
+               VALUES ('insert', NEW.annot_id, NEW.sample_id, NEW.annot_spans, NEW.annotator, NEW.label, NEW.note); END")
+    db.execute("CREATE TRIGGER IF NOT EXISTS annotations_delete_changes AFTER DELETE ON annotations \
+               BEGIN INSERT INTO annotation_changes (op, annot_id, sample_id, annotator) \
+               VALUES ('delete', OLD.annot_id, OLD.sample_id, OLD.annotator); END")
+
+
+# One row per (sample_id, text_type): the document text (its chunks joined by spaces, which is what
+# `chunks.char_offset` counts in) and the char_offsets of its chunks packed by `pack_offsets`.
+DOCUMENTS_TABLE = "CREATE TABLE IF NOT EXISTS documents (\
+    sample_id INTEGER, \
+    text_type TEXT, \
+    text TEXT, \
+    chunk_offsets BLOB, \
+    PRIMARY KEY (sample_id, text_type))"
+
+
+def pack_offsets(offsets: List[int]) -> bytes:
+    return struct.pack(f"<{len(offsets)}i", *offsets)
+
+
+def unpack_offsets(packed: bytes) -> List[int]:
+    return list(struct.unpack(f"<{len(packed) // 4}i", packed))
+
+
+def migrate_v5(db: sqlite3.Connection):
+    """Store whole documents in `documents`, backfilled from `chunks` for samples ingested before the ingester wrote them."""
+    db.execute(DOCUMENTS_TABLE)
+    if db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'chunks'").fetchone() is None:
+        return
+    rows = db.execute(
+        "SELECT sample_id, text_type, text, char_offset FROM chunks \
+         WHERE sample_id NOT IN (SELECT sample_id FROM documents) ORDER BY sample_id, text_type, chunk_offset"
+    )
+    for (sample_id, text_type), chunks in itertools.groupby(rows, key=lambda row: (row[0], row[1])):
+        chunks = list(chunks)
+        db.execute(
+            "INSERT OR IGNORE INTO documents (sample_id, text_type, text, chunk_offsets) VALUES (?, ?, ?, ?)",
+            (sample_id, text_type, " ".join(chunk[2] for chunk in chunks), pack_offsets([chunk[3] for chunk in chunks])),
+        )
+
+
+SAMPLE_HASHES_TABLE = "CREATE TABLE IF NOT EXISTS sample_hashes (content_hash BLOB PRIMARY KEY, sample_id INTEGER) WITHOUT ROWID"
+
+
+def sample_hash(documents: Dict[str, str], json_meta: str | None) -> bytes:
+    """Identifies an ingested sample by its documents (as stored in `documents`) and its `sample_meta`, so the ingester skips it the next time."""
+    return hashlib.sha256(json.dumps([sorted(documents.items()), json_meta]).encode()).digest()
+
+
+def migrate_v6(db: sqlite3.Connection):
+    """Hash every ingested sample into `sample_hashes`, including samples ingested before the ingester wrote the hashes."""
+    db.execute(SAMPLE_HASHES_TABLE)
+    db.execute("DELETE FROM sample_hashes") # hashes written by earlier versions covered the documents only
+    if db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sample_meta'").fetchone() is not None:
+        sample_meta = "(SELECT json_meta FROM sample_meta m WHERE m.sample_id = d.sample_id)"
+    else:
+        sample_meta = "NULL"
+    rows = db.execute(f"SELECT d.sample_id, d.text_type, d.text, {sample_meta} FROM documents d ORDER BY d.sample_id")
+    for sample_id, documents in itertools.groupby(rows, key=lambda row: row[0]):
+        documents = list(documents)
+        db.execute(
+            "INSERT OR IGNORE INTO sample_hashes (content_hash, sample_id) VALUES (?, ?)",
+            (sample_hash({row[1]: row[2] for row in documents}, documents[0][3]), sample_id),
+        )
+
+
+# Append new migrations at the end. `schema_version` in the config table counts how many have run.
+MIGRATIONS = [migrate_v1, migrate_v2, migrate_v3, migrate_v4, migrate_v5, migrate_v6]
+
+
+def migrate(db: sqlite3.Connection) -> int:
+    """Bring the database up to the latest schema version in place. Returns the version it was at before.
+
+    The migrations run in one `BEGIN IMMEDIATE` transaction, so concurrent server processes
+    starting on the same file wait for each other instead of migrating twice.
+    """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT)")
+        row = db.execute("SELECT value FROM config WHERE key = 'schema_version'").fetchone()
+        version = int(row[0]) if row is not None else 0
+        for new_version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            print(f"Migrating the database to schema version {new_version}")
+            migration(db)
+        if version < len(MIGRATIONS):
+            db.execute("INSERT OR REPLACE INTO config (key, value) VALUES ('schema_version', ?)", (str(len(MIGRATIONS)),))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return version
+
+
+class AnnotationWriter:
+    """Applies annotation writes from a background thread, many per transaction (group commit).
+
+    Requests submit an operation and get a Future back. The thread takes the first pending
+    operation, waits up to `max_delay` seconds for more (or until `max_batch_size`), runs them
+    in submission order in one transaction on the writer connection, commits once and only then
+    resolves the futures. So a resolved future means the write is on disk, and writes of the same
+    annotator are applied in the order they were submitted.
+    """
+
+    def __init__(self, database: "Database", max_batch_size: int = 64, max_delay: float = 0.005):
+        self.database = database
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.queue: queue.Queue = queue.Queue()
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.batches = 0
+        self.operations = 0
+        self.max_seen_batch_size = 0
+        self.commit_latencies = deque(maxlen=1000)  # seconds, of the most recent commits
+
+    def submit(self, operation: Callable, *args) -> Future:
+        """Queue `operation(db, *args)`. The future resolves with its return value once committed."""
+        if self.thread is None:
+            with self.start_lock:
+                if self.thread is None:  # started lazily, so CLI tools that only read never spawn it
+                    self.thread = threading.Thread(target=self.run, name="annotation-writer", daemon=True)
+                    self.thread.start()
+        future = Future()
+        self.queue.put((operation, args, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.apply(batch)
+            except Exception as e:
+                # e.g. the rollback itself failed. Fail this batch, but keep the thread alive for the next ones.
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def apply(self, batch: list):
+        start = time.perf_counter()
+        db = self.database.db
+        with self.database.lock:
+            try:
+                results = [operation(db, *args) for operation, args, _ in batch]
+                db.commit()
+            except Exception:
+                db.rollback()
+                results = None
+            if results is None:
+                # one bad operation should not fail the others: redo them one transaction each
+                results = []
+                for operation, args, _ in batch:
+                    try:
+                        results.append(operation(db, *args))
+                        db.commit()
+                    except Exception as e:
+                        db.rollback()
+                        results.append(e)
+        self.batches += 1
+        self.operations += len(batch)
+        self.max_seen_batch_size = max(self.max_seen_batch_size, len(batch))
+        self.commit_latencies.append(time.perf_counter() - start)
+        for (_, _, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        latencies_ms = sorted(latency * 1000 for latency in self.commit_latencies)
+        return {
+            "batches": self.batches,
+            "operations": self.operations,
+            "mean_batch_size": self.operations / self.batches if self.batches > 0 else 0,
+            "max_batch_size": self.max_seen_batch_size,
+            "pending": self.queue.qsize(),
+            "commit_ms_p50": latencies_ms[len(latencies_ms) // 2] if latencies_ms else 0,
+            "commit_ms_p99": latencies_ms[int(len(latencies_ms) * 0.99)] if latencies_ms else 0,
+        }
+
+
 class Database:
 # class Annotate:
     # def __init__(self, annotation_corpus_id: int, vectara_client: Vectara = Vectara()):
-    def __init__(self, sqlite_db_path: str):
-        self.lock = threading.Lock()
+    def __init__(self, sqlite_db_path: str, write_batch_size: int = 64, write_delay: float = 0.005):
+        self.sqlite_db_path = sqlite_db_path
+        self.lock = threading.Lock() # serialises the single writer connection `self.db`
+        self.local = threading.local() # holds one read-only connection per thread, see `read_db`
         # self.vectara_client = vectara_client
         # self.annotation_corpus_id = annotation_corpus_id
         # annotation_records: List[LabelData] = fetch_annotations_from_corpus(
@@ -150,32 +417,46 @@ class Database:
         # self.annotations = fetch_annotations(sqlite_db_path)
 
         # prepare the database
-        db = sqlite3.connect(sqlite_db_path)
+        db = self.connect()
         print ("Open db at ", sqlite_db_path)
-        db.execute("CREATE TABLE IF NOT EXISTS annotations (\
-                   annot_id INTEGER PRIMARY KEY AUTOINCREMENT, \
-                   sample_id INTEGER, \
-                   annot_spans TEXT, \
-                   annotator TEXT, \
-                   label TEXT, \
-                   note TEXT)")
-        db.execute(
-            "CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, user_name TEXT)"
-        )
+        # WAL lets the read connections proceed while the writer commits, and never block it
+        db.execute("PRAGMA journal_mode = WAL")
+        migrate(db)
+        # per-sample lookups of chunks (selection search, span matching) need this index. Older ingests lack it.
+        if db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'chunks'").fetchone() is not None:
+            db.execute("CREATE INDEX IF NOT EXISTS chunks_sample_id ON chunks (sample_id, text_type, chunk_offset)")
+        db.commit()
+        self.db = db # the only connection that writes. Use it under `database_lock`
+        self.writer = AnnotationWriter(self, max_batch_size=write_batch_size, max_delay=write_delay)
+
+    def connect(self, read_only: bool = False) -> sqlite3.Connection:
+        # several server processes may write to the same file. `timeout` is SQLite's busy timeout:
+        # wait that long for another process's write lock instead of failing with "database is locked"
+        if read_only:
+            uri = pathlib.Path(self.sqlite_db_path).absolute().as_uri() + "?mode=ro"
+            db = sqlite3.connect(uri, uri=True, check_same_thread=False, timeout=30)
+        else:
+            db = sqlite3.connect(self.sqlite_db_path, check_same_thread=False, timeout=30)
         db.enable_load_extension(True)
         sqlite_vec.load(db)
         db.enable_load_extension(False)
-        db.commit()
-        self.db = db # Forrst is unsure whether it is a good idea to keep the db connection open
+        return db
+
+    @property
+    def read_db(self) -> sqlite3.Connection:
+        """The read-only connection of the calling thread. Reads never wait for the lock or for each other."""
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.connect(read_only=True)
+            self.local.db = db
+        return db
 
     @staticmethod # Forrest: Seems no need to update this function after Vectara-to-SQLite migration
     def database_lock():
         def decorator(func):
             def wrapper(self, *args, **kwargs):
-                self.lock.acquire()
-                result = func(self, *args, **kwargs)
-                self.lock.release()
-                return result
+                with self.lock:
+                    return func(self, *args, **kwargs)
             return wrapper
         return decorator
 
@@ -183,58 +464,26 @@ class Database:
         """Fetch the source-summary pairs for labeling from the database."""
 
         data_for_labeling = {}
-        sectioned_chunks = {} 
         # db = sqlite3.connect(sqlite_db_path)
-        db = self.db
-        texts = db.execute("SELECT text, text_type, sample_id, chunk_offset FROM chunks").fetchall()
-        """ texts = 
-        [('The quick brown fox.', 'source', 1, 0),
-        ('Jumps over a lazy dog.', 'source', 1, 1),
-        ('We the people.', 'source', 2, 0),
-        ('Of the U.S.A.', 'source', 2, 1),
-        ('26 letters.', 'summary', 1, 0),
-        ('The U.S. Constitution.', 'summary', 2, 0),
-        ('It is great.', 'summary', 2, 1)]
-        """
-        for text, text_type, sample_id, chunk_offset in texts:
-            sectioned_chunks.setdefault(sample_id, {}).setdefault(text_type, {})[chunk_offset] = text
-            # levels: sample_id -> text_type -> chunk_offset -> text
-
-        # sort chunks by chunk_offset as dictionary 
-        for sample_id in sectioned_chunks:
-            for text_type in sectioned_chunks[sample_id]:
-                sectioned_chunks[sample_id][text_type] = dict(sorted(sectioned_chunks[sample_id][text_type].items()))
-
-        """ sectioned_chunks =
-        {
-            1: {
-                'source': {
-                    0: 'The quick brown fox.',
-                    1: 'Jumps over a lazy dog.'
-                }, 
-                'summary': {
-                    0: '26 letters.'
-                }
-            },
-            2: {
-                'source': {
-                    0: 'We the people.',
-                    1: 'Of the U.S.A.'
-                }, 
-                'summary': {
-                    0: 'The U.S. Constitution.',
-                    1: 'It is great.'
-                }
-            }
+        db = self.read_db
+        documents = db.execute("SELECT sample_id, text_type, text FROM documents").fetchall()
+        """ documents = 
+        [(1, 'source', 'The quick brown fox. Jumps over a lazy dog.'),
+        (1, 'summary', '26 letters.'),
+        (2, 'source', 'We the people. Of the U.S.A.'),
+        (2, 'summary', 'The U.S. Constitution. It is great.')]
         """
+        sectioned_documents = {}
+        for sample_id, text_type, text in documents:
+            sectioned_documents.setdefault(sample_id, {"source": "", "summary": ""})[text_type] = text
 
         data_for_labeling = [
             {
                 "_id": str(sample_id), 
-                "source": " ".join(sectioned_chunks[sample_id]["source"].values()),
-                "summary": " ".join(sectioned_chunks[sample_id]["summary"].values())
+                "source": sectioned_documents[sample_id]["source"],
+                "summary": sectioned_documents[sample_id]["summary"]
             }
-            for sample_id in sectioned_chunks
+            for sample_id in sectioned_documents
         ]
 
         """ data_for_labeling =
@@ -259,12 +508,28 @@ class Database:
     
     def fetch_configs(self):
         # db = sqlite3.connect(sqlite_db_path)
-        db = self.db
+        db = self.read_db
         configs = db.execute("SELECT key, value FROM config").fetchall()
         return {key: value for key, value in configs}
 
-    @database_lock()
-    def push_annotation(self, label_data: OldLabelData):
+    def labels_etag(self) -> str:
+        """An ETag for the annotation export that changes whenever annotations, user names or ingested samples do.
+
+        It only reads two config rows, so checking for changes never touches the data tables.
+        """
+        rows = dict(self.read_db.execute(
+            "SELECT key, value FROM config WHERE key IN ('labels_version', 'ingest_checkpoint')"
+        ).fetchall())
+        version = f"{rows.get('labels_version')}:{rows.get('ingest_checkpoint')}"
+        return '"' + hashlib.sha256(version.encode()).hexdigest()[:32] + '"'
+
+    def push_annotation(self, label_data: OldLabelData) -> Future:
+        """Queue the annotation on the group-commit writer. The future resolves once it is committed."""
+        return self.writer.submit(self.insert_annotation, label_data)
+
+    @staticmethod
+    def insert_annotation(db: sqlite3.Connection, label_data: OldLabelData):
+        """Runs on the writer thread, inside the batch transaction. See `AnnotationWriter`."""
         # First make sure there is no duplicate in the DB
         # if (
         #         (self.annotations["sample_id"] == label_data["sample_id"]) &
@@ -277,17 +542,6 @@ class Database:
         # ).any():
         #     return
 
-        sql_cmd = "SELECT * FROM annotations WHERE sample_id = ? AND annot_spans = ? AND annotator = ? AND label = ? AND note = ?"
-        res = self.db.execute(sql_cmd, (
-            label_data["sample_id"],
-            json.dumps(label_data["annot_spans"]),
-            label_data["annotator"],
-            label_data["label"],
-            label_data["note"]
-        ))
-        if res.fetchone() is not None:
-            return
-
         # record_id = uuid.uuid4().hex # No need for this line in SQLite because it auto-increments
         # label_data["record_id"] = record_id
         # self.annotations.loc[len(self.annotations.index)] = (
@@ -310,19 +564,24 @@ class Database:
 
         # label_data = convert_LabelData(label_data, "old2new")
 
-        sql_cmd = "INSERT INTO annotations (sample_id, annot_spans, annotator, label, note) VALUES (?, ?, ?, ?, ?)"
-        self.db.execute(sql_cmd, (
+        # duplicates hit the unique index on content_hash and are skipped
+        content = (
             label_data["sample_id"],
             json.dumps(label_data["annot_spans"]),
             label_data["annotator"],
             label_data["label"],
             label_data["note"]
-        ))
-        self.db.commit()
+        )
+        sql_cmd = "INSERT OR IGNORE INTO annotations (sample_id, annot_spans, annotator, label, note, content_hash) VALUES (?, ?, ?, ?, ?, ?)"
+        db.execute(sql_cmd, (*content, annotation_hash(*content)))
 
-    @database_lock()
     # def delete_annotation(self, record_id: str, user_id: str):
-    def delete_annotation(self, record_id: str, annotator: str):
+    def delete_annotation(self, record_id: str, annotator: str) -> Future:
+        """Queue the deletion on the group-commit writer. The future resolves once it is committed."""
+        return self.writer.submit(self.remove_annotation, record_id, annotator)
+
+    @staticmethod
+    def remove_annotation(db: sqlite3.Connection, record_id: str, annotator: str):
         # if not (
         #         (self.annotations["record_id"] == record_id)
         #         & (self.annotations["user_id"] == user_id)
@@ -332,8 +591,7 @@ class Database:
         # self.annotations.drop(record_index, inplace=True)
         # self.vectara_client.delete_document(self.annotation_corpus_id, record_id)
         sql_cmd = "DELETE FROM annotations WHERE annot_id = ? AND annotator = ?"
-        self.db.execute(sql_cmd, (int(record_id), annotator))
-        self.db.commit()
+        db.execute(sql_cmd, (int(record_id), annotator))
     
     @database_lock()
     def add_user(self, user_id: str, user_name: str):
@@ -347,29 +605,19 @@ class Database:
         self.db.execute(sql_cmd, (user_name, user_id))
         self.db.commit()
     
-    @database_lock()
     def get_user_name(self, user_id: str) -> str:
         sql_cmd = "SELECT user_name FROM users WHERE user_id = ?"
-        res = self.db.execute(sql_cmd, (user_id,))
-        user_name = res.fetchone()
-        if user_name is None:
-            return None
-        return user_name[0]
-    
-    def get_user_name_without_lock(self, user_id: str) -> str:
-        sql_cmd = "SELECT user_name FROM users WHERE user_id = ?"
-        res = self.db.execute(sql_cmd, (user_id,))
+        res = self.read_db.execute(sql_cmd, (user_id,))
         user_name = res.fetchone()
         if user_name is None:
             return None
         return user_name[0]
 
-    @database_lock()
     # def export_user_data(self, user_id: str) -> list[LabelData]:
     def export_user_data(self, annotator: str) -> list[LabelData]:
         # return self.annotations[self.annotations["user_id"] == user_id].to_dict(orient="records")
-        sql_cmd = "SELECT * FROM annotations WHERE annotator = ?"
-        res = self.db.execute(sql_cmd, (annotator,))
+        sql_cmd = "SELECT annot_id, sample_id, annot_spans, annotator, label, note FROM annotations WHERE annotator = ?"
+        res = self.read_db.execute(sql_cmd, (annotator,))
         annotations = res.fetchall()
         label_data = [] # in OldLabelData format
         for annot_id, sample_id, annot_spans, annotator, label, note in annotations:
@@ -384,15 +632,14 @@ class Database:
             }, "new2old"))
         return label_data
 
-    @database_lock()
     # def export_task_history(self, task_index: int, user_id: str) -> list[LabelData]:
     def export_task_history(self, sample_id: int, annotator: str) -> list[LabelData]:
         # return self.annotations[
         #         (self.annotations["user_id"] == user_id) &
         #         (self.annotations["task_index"] == task_index)
         #     ].to_dict(orient="records")
-        sql_cmd = "SELECT * FROM annotations WHERE annotator = ? AND sample_id = ?"
-        res = self.db.execute(sql_cmd, (annotator, sample_id))
+        sql_cmd = "SELECT annot_id, sample_id, annot_spans, annotator, label, note FROM annotations WHERE annotator = ? AND sample_id = ?"
+        res = self.read_db.execute(sql_cmd, (annotator, sample_id))
         annotations = res.fetchall()
         label_data = []
         for annot_id, sample_id, annot_spans, annotator, label, note in annotations:
@@ -407,57 +654,133 @@ class Database:
             }, "new2old"))
         return label_data
     
-    @database_lock()
-    def dump_annotator_labels(self, annotator: str):
-        sql_cmd = "SELECT * FROM annotations WHERE annotator = ?"
-        res = self.db.execute(sql_cmd, (annotator,))
-        annotations = res.fetchall()
-        results = []
-        results_dict = {}
-        for annot_id, sample_id, annot_spans, annotator, label, note in annotations:
-            # find the source and summary text by doc_id
-            full_texts = {}
-            for text_type in ["source", "summary"]:
-                sql_cmd = "SELECT text FROM chunks WHERE sample_id = ? AND text_type = ? ORDER BY chunk_offset"
-                res = self.db.execute(sql_cmd, (sample_id, text_type))
-                text = res.fetchall() # text =  [('The quick brown fox.',), ('Jumps over a lazy dog.',)]
-                text = [t[0] for t in text]
-                full_texts[text_type] = " ".join(text)
-            
-            result_local = {"annot_id": annot_id, "sample_id": sample_id, "annotator": annotator, "label": json.loads(label), "note": note, "annotator_name": self.get_user_name_without_lock(annotator)}
-            # annot_spans example: {'source': (1, 10), 'summary': (7, 10)}
-            annot_spans = json.loads(annot_spans)
-            for text_type, (start, end) in annot_spans.items():
-                # print(full_texts)
-                result_local[f"{text_type}_span"] = full_texts[text_type][start:end]
-                result_local[f"{text_type}_start"] = start
-                result_local[f"{text_type}_end"] = end
-
-            results.append(result_local)
-
-            results_dict.setdefault(sample_id, {"source": full_texts["source"], "summary": full_texts["summary"], "annotations": []})
-            results_dict[sample_id]["annotations"].append(result_local)
-
-        results_nested = [{"sample_id": key, **value} for key, value in results_dict.items()]
-
-        # TODO: copy and paste from dump_annotation is too ugly. Please turn common code to a function
-
-        sql_cmd = "SELECT * from sample_meta" # get the metadata
-        res = self.db.execute(sql_cmd)
-        sample_meta = res.fetchall()
-        sample_meta_dict = {sample_id: json.loads(json_meta) for sample_id, json_meta in sample_meta}
-        sample_meta_dict = {sample_id: {f"meta_{k}": v for k, v in meta.items()} for sample_id, meta in sample_meta_dict.items()}
-
-        # add metadata to each dict in results_nested
-        new_results_nested = []
-        for result in results_nested:
-            sample_id = result["sample_id"]
-            new_results_nested.append(result | sample_meta_dict[sample_id])
-        results_nested = new_results_nested
+    def iter_export(
+            self,
+            annotator: str | None = None,
+            label: str | None = None,
+            sample_id_min: int | None = None,
+            sample_id_max: int | None = None,
+            limit: int | None = None,
+    ) -> Iterator[dict]:
+        """Yield one export record per sample, in sample_id order, with constant memory.
+
+        A record holds the full source and summary, the sample's annotations and its `meta_*` fields.
+        Documents, annotations and sample_meta are each read with one query ordered by sample_id
+        and merged. Annotator names are loaded up front in one query.
+        With `annotator` and/or `label` (one of the labels in the annotation), only the matching
+        annotations and the samples that have some are exported. Otherwise every sample in the
+        sample_id range is exported, annotated or not. `limit` caps the number of samples.
+        """
+        db = self.connect(read_only=True) # own connection: a streaming response may resume the generator in any thread
+        try:
+            # one read transaction for the whole export: all queries see the same point-in-time snapshot,
+            # and with WAL it does not hold up the annotation writer
+            db.execute("BEGIN")
+            user_names = dict(db.execute("SELECT user_id, user_name FROM users").fetchall())
+
+            sample_conditions, sample_params = [], []
+            if sample_id_min is not None:
+                sample_conditions.append("sample_id >= ?")
+                sample_params.append(sample_id_min)
+            if sample_id_max is not None:
+                sample_conditions.append("sample_id <= ?")
+                sample_params.append(sample_id_max)
+            annotation_conditions, annotation_params = list(sample_conditions), list(sample_params)
+            if annotator is not None:
+                annotation_conditions.append("annotator = ?")
+                annotation_params.append(annotator)
+            if label is not None:
+                annotation_conditions.append("EXISTS (SELECT 1 FROM json_each(annotations.label) WHERE json_each.value = ?)")
+                annotation_params.append(label)
+            annotations_filtered = annotator is not None or label is not None
+            if annotations_filtered:
+                sample_conditions.append("sample_id IN (SELECT sample_id FROM annotations WHERE {0})".format(" AND ".join(annotation_conditions)))
+                sample_params.extend(annotation_params)
+
+            def where(conditions: List[str]) -> str:
+                return "WHERE " + " AND ".join(conditions) if len(conditions) > 0 else ""
+
+            # each cursor yields (sample_id, rows of that sample), in sample_id order
+            document_groups = itertools.groupby(db.execute(
+                f"SELECT sample_id, text_type, text FROM documents {where(sample_conditions)} ORDER BY sample_id, text_type", sample_params
+            ), key=lambda row: row[0])
+            annotation_groups = itertools.groupby(db.execute(
+                f"SELECT annot_id, sample_id, annot_spans, annotator, label, note FROM annotations {where(annotation_conditions)} ORDER BY sample_id, annot_id", annotation_params
+            ), key=lambda row: row[1])
+            meta_groups = itertools.groupby(db.execute(
+                f"SELECT sample_id, json_meta FROM sample_meta {where(sample_conditions)} ORDER BY sample_id", sample_params
+            ), key=lambda row: row[0])
+
+            exported = 0
+            heads = [next(groups, None) for groups in (document_groups, annotation_groups, meta_groups)]
+            while any(head is not None for head in heads) and (limit is None or exported < limit):
+                sample_id = min(head[0] for head in heads if head is not None)
+                documents, annotations, meta = [], [], []
+                for i, (groups, rows) in enumerate(zip((document_groups, annotation_groups, meta_groups), (documents, annotations, meta))):
+                    if heads[i] is not None and heads[i][0] == sample_id:
+                        rows.extend(heads[i][1])
+                        heads[i] = next(groups, None)
+                if annotations_filtered and len(annotations) == 0:
+                    continue
+
+                full_texts = {"source": "", "summary": ""}
+                for _, text_type, text in documents:
+                    full_texts[text_type] = text
+
+                record = {"sample_id": sample_id, "source": full_texts["source"], "summary": full_texts["summary"], "annotations": []}
+                for annot_id, _, annot_spans, annot_annotator, label, note in annotations:
+                    result_local = {"annot_id": annot_id, "sample_id": sample_id, "annotator": annot_annotator, "label": json.loads(label), "note": note, "annotator_name": user_names.get(annot_annotator)}
+                    # annot_spans example: {'source': (1, 10), 'summary': (7, 10)}
+                    for text_type, (start, end) in json.loads(annot_spans).items():
+                        result_local[f"{text_type}_span"] = full_texts[text_type][start:end]
+                        result_local[f"{text_type}_start"] = start
+                        result_local[f"{text_type}_end"] = end
+                    record["annotations"].append(result_local)
+                for _, json_meta in meta:
+                    record.update({f"meta_{k}": v for k, v in json.loads(json_meta).items()})
+                exported += 1
+                yield record
+        finally:
+            db.rollback()
+            db.close()
+
+    def iter_changes(self, since: int = 0, limit: int | None = None) -> Iterator[dict]:
+        """Yield the annotation inserts and deletes logged after sequence number `since`, oldest first.
+
+        Apply them in order to a copy of the annotations to bring it up to date. Then pass the `seq`
+        of the last change as `since` next time.
+        """
+        db = self.connect(read_only=True) # own connection: a streaming response may resume the generator in any thread
+        try:
+            rows = db.execute(
+                "SELECT seq, op, annot_id, sample_id, annot_spans, annotator, label, note FROM annotation_changes \
+                 WHERE seq > ? ORDER BY seq LIMIT ?",
+                (since, -1 if limit is None else limit),
+            )
+            for seq, op, annot_id, sample_id, annot_spans, annotator, label, note in rows:
+                change = {"seq": seq, "op": op, "annot_id": annot_id, "sample_id": sample_id, "annotator": annotator}
+                if op == "insert":
+                    change.update({"annot_spans": json.loads(annot_spans), "label": json.loads(label), "note": note})
+                yield change
+        finally:
+            db.close()
+
+    def backup(self, backup_path: str):
+        """Copy the database to `backup_path` with SQLite's online backup API, as a consistent snapshot.
+
+        The copy runs in one step on a read connection, so with WAL annotation writes carry on meanwhile.
+        """
+        source = self.connect(read_only=True)
+        target = sqlite3.connect(backup_path)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
 
-        return results_nested
+    def dump_annotator_labels(self, annotator: str):
+        return list(self.iter_export(annotator))
 
-    @database_lock()
     # def dump_all_data(
     def dump_annotation(
             self,
@@ -465,74 +788,83 @@ class Database:
             # source_corpus_id: int | None = None,
             # summary_corpus_id: int | None = None,
     ):
+        """Export every sample with its annotations. Writes JSONL if `dump_file` ends with `.jsonl`, else JSON.
 
-        sql_cmd = "SELECT * FROM annotations"
-        res = self.db.execute(sql_cmd)
-        annotations = res.fetchall()
-
-        # match annotations with chunks by doc_id
-        results = []
-        results_dict = {} # keys are sample_id, values are source text, summary text, and each pair of spans and labels and annotators
-        for annot_id, sample_id, annot_spans, annotator, label, note in annotations:
-            # find the source and summary text by doc_id
-            full_texts = {}
-            for text_type in ["source", "summary"]:
-                sql_cmd = "SELECT text FROM chunks WHERE sample_id = ? AND text_type = ? ORDER BY chunk_offset"
-                res = self.db.execute(sql_cmd, (sample_id, text_type))
-                text = res.fetchall() # text =  [('The quick brown fox.',), ('Jumps over a lazy dog.',)]
-                text = [t[0] for t in text]
-                full_texts[text_type] = " ".join(text)
-            
-            result_local = {"annot_id": annot_id, "sample_id": sample_id, "annotator": annotator, "label": json.loads(label), "note": note, "annotator_name": self.get_user_name_without_lock(annotator)}
-            # annot_spans example: {'source': (1, 10), 'summary': (7, 10)}
-            annot_spans = json.loads(annot_spans)
-            for text_type, (start, end) in annot_spans.items():
-                result_local[f"{text_type}_span"] = full_texts[text_type][start:end]
-                result_local[f"{text_type}_start"] = start
-                result_local[f"{text_type}_end"] = end
-
-            results.append(result_local)
-
-            results_dict.setdefault(sample_id, {"source": full_texts["source"], "summary": full_texts["summary"], "annotations": []})
-            results_dict[sample_id]["annotations"].append(result_local)
-
-        results_nested = [{"sample_id": key, **value} for key, value in results_dict.items()]
-
-        sql_cmd = "SELECT * from sample_meta" # get the metadata
-        res = self.db.execute(sql_cmd)
-        sample_meta = res.fetchall()
-        sample_meta_dict = {sample_id: json.loads(json_meta) for sample_id, json_meta in sample_meta}
-        sample_meta_dict = {sample_id: {f"meta_{k}": v for k, v in meta.items()} for sample_id, meta in sample_meta_dict.items()}
-
-        # add metadata to each dict in results_nested
-        new_results_nested = []
-        annotated_sample_ids = set()
-        for result in results_nested:
-            sample_id = result["sample_id"]
-            new_results_nested.append(result | sample_meta_dict[sample_id])
-            annotated_sample_ids.add(sample_id)
-        for sample_id in sample_meta_dict:
-            if sample_id not in annotated_sample_ids:
-                full_texts = {}
-                for text_type in ["source", "summary"]:
-                    sql_cmd = "SELECT text FROM chunks WHERE sample_id = ? AND text_type = ? ORDER BY chunk_offset"
-                    res = self.db.execute(sql_cmd, (sample_id, text_type))
-                    text = res.fetchall() # text =  [('The quick brown fox.',), ('Jumps over a lazy dog.',)]
-                    text = [t[0] for t in text]
-                    full_texts[text_type] = " ".join(text)
-                sample_dict = {"sample_id": sample_id, "source": full_texts["source"], "summary": full_texts["summary"], "annotations": []}
-                sample_dict.update(sample_meta_dict[sample_id])
-                new_results_nested.append(sample_dict)
-        
-        results_nested = new_results_nested
-        results_nested = sorted(results_nested, key=lambda d: d['sample_id'])
-        
+        With `dump_file=None` the records are returned as a list instead.
+        """
+        records = self.iter_export()
         if dump_file is None:
-            return results_nested
+            return list(records)
+        encode = encode_jsonl if dump_file.endswith(".jsonl") else encode_json
         with open(dump_file, "w") as f:
-            json.dump(results_nested, f, indent=2, ensure_ascii=False)
-            #TODO add JSONL support. Automatically detect file format based on filename extension
+            for piece in encode(records):
+                f.write(piece)
+
+
+class TaskStore:
+    """The source-summary pairs to label, read from the `documents` table on demand.
+
+    A task index is the sample_id. Documents are read per sample with a primary-key lookup and
+    kept in a bounded LRU, so the server starts without reading the whole corpus.
+    """
+
+    def __init__(self, database: Database, max_tasks: int = 1024):
+        self.database = database
+        self.max_tasks = max_tasks
+        self.tasks: OrderedDict[int, dict] = OrderedDict()
+        self.lock = threading.Lock() # `get` runs in FastAPI's thread pool
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        # sample ids are assigned contiguously from 0 at ingestion, and this is one index lookup
+        row = self.database.read_db.execute("SELECT MAX(sample_id) + 1 FROM documents").fetchone()
+        return row[0] or 0
+
+    def get(self, task_index: int) -> dict | None:
+        """The task as {"_id", "source", "summary"} like `Database.fetch_data_for_labeling`, or None if there is no such sample."""
+        with self.lock:
+            task = self.tasks.get(task_index)
+            if task is not None:
+                self.tasks.move_to_end(task_index)
+                self.hits += 1
+                return task
+            self.misses += 1
+        rows = self.database.read_db.execute(
+            "SELECT text_type, text FROM documents WHERE sample_id = ?", (task_index,)
+        ).fetchall()
+        if len(rows) == 0:
+            return None
+        texts = {"source": "", "summary": ""}
+        texts.update(rows)
+        task = {"_id": str(task_index), "source": texts["source"], "summary": texts["summary"]}
+        with self.lock:
+            self.tasks[task_index] = task
+            if len(self.tasks) > self.max_tasks:
+                self.tasks.popitem(last=False)
+        return task
+
+    def stats(self) -> dict:
+        return {
+            "tasks": len(self.tasks),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def encode_json(records: Iterable[dict]) -> Iterator[str]:
+    """Encode records as a JSON array piece by piece. The output is the same as `json.dump(list(records), f, indent=2)`."""
+    first = True
+    for record in records:
+        item = json.dumps(record, indent=2, ensure_ascii=False).replace("\n", "\n  ")
+        yield ("[\n  " if first else ",\n  ") + item
+        first = False
+    yield "[]" if first else "\n]"
+
 
+def encode_jsonl(records: Iterable[dict]) -> Iterator[str]:
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False) + "\n"
 
 if __name__ == "__main__":
     import argparse
@@ -553,11 +885,23 @@ if __name__ == "__main__":
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
     parser.add_argument("sqlite_db_path", type=str, help="Path to the SQLite database")
-    parser.add_argument("--dump_file", type=str, default="mercury_annotations.json")
+    parser.add_argument("--dump_file", type=str, default="mercury_annotations.json", help="Written as JSON Lines if it ends with .jsonl")
+    parser.add_argument("--changes_since", type=int, default=None, help="Instead of the full dump, write the annotation inserts and deletes after this sequence number to the dump file as JSON Lines")
+    parser.add_argument("--snapshot", type=str, default=None, help="First copy the database to this file with the SQLite backup API, then dump from the copy. The copy is kept")
     args = parser.parse_args()
 
     # db = Database(args.annotation_corpus_id)
     db_obj = Database(args.sqlite_db_path)
-    print(f"Dumping all data to {args.dump_file}")
-    # db.dump_all_data(args.dump_file, args.source_corpus_id, args.summary_corpus_id)
-    db_obj.dump_annotation(args.dump_file)
+    if args.snapshot is not None:
+        print(f"Taking a snapshot of {args.sqlite_db_path} at {args.snapshot}")
+        db_obj.backup(args.snapshot)
+        db_obj = Database(args.snapshot)
+    if args.changes_since is not None:
+        print(f"Dumping annotation changes after {args.changes_since} to {args.dump_file}")
+        with open(args.dump_file, "w") as f:
+            for piece in encode_jsonl(db_obj.iter_changes(args.changes_since)):
+                f.write(piece)
+    else:
+        print(f"Dumping all data to {args.dump_file}")
+        # db.dump_all_data(args.dump_file, args.source_corpus_id, args.summary_corpus_id)
+        db_obj.dump_annotation(args.dump_file)
@@ -0,0 +1,557 @@
+import asyncio
+import hashlib
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Literal, Tuple
+
+import numpy as np
+
+
+class EmbeddingDispatcher:
+    """Runs `Embedder.embed` off the event loop and micro-batches queries across requests.
+
+    Queries that arrive within `batch_window` seconds of the first pending one are
+    embedded together in a single `embed` call on a worker thread. Each caller awaits
+    its own future and gets back only its own vector.
+    """
+
+    def __init__(
+        self,
+        embedder,
+        embedding_dimension: int,
+        batch_window: float = 0.005,
+        max_batch_size: int = 32,
+        num_workers: int = 1,
+    ):
+        self.embedder = embedder
+        self.embedding_dimension = embedding_dimension
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="embed")
+        self.pending: List[tuple[str, asyncio.Future]] = []
+        self.flush_handle: asyncio.TimerHandle | None = None
+        self.tasks: set[asyncio.Task] = set() # the event loop keeps only weak references to running batches
+
+    async def embed(self, text: str) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((text, future))
+        if len(self.pending) >= self.max_batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.batch_window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if len(batch) > 0:
+            task = asyncio.ensure_future(self.run_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run_batch(self, batch: List[tuple[str, asyncio.Future]]):
+        loop = asyncio.get_running_loop()
+        texts = [text for text, _ in batch]
+        try:
+            embeddings = await loop.run_in_executor(
+                self.executor,
+                lambda: self.embedder.embed(texts, embedding_dimension=self.embedding_dimension, batch_size=len(texts)),
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():  # the request may have been cancelled while waiting
+                future.set_result(embedding)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class TokenBucket:
+    """Token bucket enforcing a tokens-per-minute budget.
+
+    The state is guarded by a thread lock, so one bucket can be shared by every call of a client,
+    each of which may run on its own event loop.
+    """
+
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self.tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, tokens: int) -> float:
+        """Take `tokens` if the bucket holds them and return 0, or else return the seconds to wait for them."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    async def acquire(self, tokens: int, queue: asyncio.Lock):
+        """Wait for `tokens`. Requests holding the same `queue` lock are served first come, first served."""
+        tokens = min(tokens, self.capacity) # a request bigger than the budget waits for a full bucket
+        async with queue:
+            while (delay := self.take(tokens)) > 0:
+                await asyncio.sleep(delay)
+
+
+class OpenAIEmbeddingClient:
+    """Concurrent client for OpenAI's embeddings endpoint.
+
+    Inputs are packed into requests of at most `max_items` inputs and `max_request_tokens` tokens,
+    up to `max_concurrency` requests are kept in flight within a tokens-per-minute budget, and 429s
+    and transient errors are retried with exponential backoff. Output order always matches the input.
+    `base_url` (or OPENAI_BASE_URL) can point it at any server mimicking the endpoint.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        max_concurrency: int = 8,
+        tokens_per_minute: int = 1_000_000,
+        max_items: int = 2048,
+        max_request_tokens: int = 300_000,
+        max_retries: int = 8,
+        base_url: str | None = None,
+    ):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.max_items = max_items
+        self.max_request_tokens = max_request_tokens
+        self.max_retries = max_retries
+        self.base_url = base_url
+        self.budget = TokenBucket(tokens_per_minute) # shared by all calls, so the budget holds across batches
+        try:
+            import tiktoken
+            self.encoding = tiktoken.get_encoding("cl100k_base")
+        except ImportError: # estimate instead
+            self.encoding = None
+
+    def count_tokens(self, text: str) -> int:
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return len(text) // 3 + 1
+
+    def pack(self, texts: List[str]) -> List[Tuple[int, int, int]]:
+        """Split texts into consecutive (start, end, num_tokens) requests within the item and token limits."""
+        requests = []
+        start, tokens = 0, 0
+        for i, text in enumerate(texts):
+            text_tokens = self.count_tokens(text)
+            if i > start and (i - start >= self.max_items or tokens + text_tokens > self.max_request_tokens):
+                requests.append((start, i, tokens))
+                start, tokens = i, 0
+            tokens += text_tokens
+        if start < len(texts):
+            requests.append((start, len(texts), tokens))
+        return requests
+
+    async def embed_async(self, texts: List[str], dimensions: int | None = None) -> np.ndarray:
+        import openai
+
+        client = openai.AsyncOpenAI(base_url=self.base_url, max_retries=0) # retries are handled below
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        queue = asyncio.Lock() # bound to this call's event loop
+
+        async def send(start: int, end: int, tokens: int) -> List[List[float]]:
+            kwargs = {"dimensions": int(dimensions)} if dimensions is not None else {}
+            for attempt in range(self.max_retries + 1):
+                await self.budget.acquire(tokens, queue)
+                async with semaphore:
+                    try:
+                        response = await client.embeddings.create(input=texts[start:end], model=self.model, **kwargs)
+                        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+                    except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+                        if attempt == self.max_retries:
+                            raise
+                        retry_after = None
+                        if isinstance(e, openai.APIStatusError):
+                            retry_after = e.response.headers.get("retry-after")
+                        delay = float(retry_after) if retry_after is not None else min(60, 0.5 * 2 ** attempt)
+                await asyncio.sleep(delay * (0.5 + random.random())) # outside the semaphore so others can proceed
+
+        try:
+            results = await asyncio.gather(*(send(*request) for request in self.pack(texts)))
+        finally:
+            await client.close()
+        return np.array([embedding for result in results for embedding in result], dtype=np.float32)
+
+    def embed(self, texts: List[str], dimensions: int | None = None) -> np.ndarray:
+        """Blocking wrapper of `embed_async`, for callers outside an event loop (worker threads, the ingester)."""
+        return asyncio.run(self.embed_async(texts, dimensions))
+
+
+class Embedder: 
+    def __init__(self, name: Literal['bge-small-en-v1.5', 'openai', 'all-mpnet-base-v2', 'multi-qa-mpnet-base-dot-v1'], openai_max_concurrency: int = 8, openai_tokens_per_minute: int = 1_000_000) -> None:
+        self.name = name 
+        self.use_sentence_transformers = False
+        if name in ['bge-small-en-v1.5']:
+            from sentence_transformers import SentenceTransformer
+            self.model = SentenceTransformer(f'BAAI/{name}')
+            self.use_sentence_transformers = True
+        elif 'openai' in name:
+            self.model = OpenAIEmbeddingClient(
+                name.split("/")[-1], max_concurrency=openai_max_concurrency, tokens_per_minute=openai_tokens_per_minute
+            )
+        elif name in ['multi-qa-mpnet-base-dot-v1', 'all-mpnet-base-v2']:
+            from sentence_transformers import SentenceTransformer
+            self.model = SentenceTransformer(f'sentence-transformers/{name}')
+            self.use_sentence_transformers = True
+        else: 
+            print (f"Unsupported embedder {name}. Please check. ")
+            exit() 
+    
+    def embed(self, texts: List[str], embedding_dimension: int= 512,  batch_size:int = 12) -> np.ndarray:
+        """The function that takes a list of strings and returns a numpy array of their embeddings.
+        """
+        if self.use_sentence_transformers:
+            return self.model.encode(texts, batch_size=batch_size, normalize_embeddings=True)
+        # elif self.name == 'bge-m3':
+        #     return self.model.encode(texts, batch_size=batch_size, max_length=512)['dense_vecs']
+        elif "openai" in self.name:
+            return self.model.embed(texts, dimensions=int(embedding_dimension))
+        else:
+            # return dummy embeddings
+            print (f"Returning dummy embeddings")
+            return np.random.rand(len(texts), embedding_dimension)
+
+
+class BackgroundEmbedder:
+    """Loads an `Embedder` in a background thread, so the server can take requests while the model loads.
+
+    `embed` waits until the model is loaded. It runs on the dispatcher's worker threads, so only
+    requests that need a new embedding wait, never the event loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.embedder = None
+        self.error = None
+        self.load_seconds = None
+        self.loaded = threading.Event()
+        threading.Thread(target=self.load, args=args, kwargs=kwargs, name="embedder-loader", daemon=True).start()
+
+    def load(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            self.embedder = Embedder(*args, **kwargs)
+        except BaseException as e:  # Embedder calls exit() on an unknown model name
+            self.error = e
+        self.load_seconds = time.perf_counter() - start
+        self.loaded.set()
+
+    def is_ready(self) -> bool:
+        return self.loaded.is_set() and self.error is None
+
+    def embed(self, texts: List[str], embedding_dimension: int = 512, batch_size: int = 12) -> np.ndarray:
+        self.loaded.wait()
+        if self.error is not None:
+            raise RuntimeError(f"The embedding model failed to load: {self.error!r}")
+        return self.embedder.embed(texts, embedding_dimension=embedding_dimension, batch_size=batch_size)
+
+    def stats(self) -> dict:
+        return {"ready": self.is_ready(), "load_seconds": self.load_seconds, "error": None if self.error is None else repr(self.error)}
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """A persistent, content-addressed store of embeddings in the `embedding_cache` table of a SQLite file.
+
+    Entries are keyed by (sha256(text), embedding_model_id, embedding_dimension), so a sentence is never
+    embedded twice by the same model, across re-ingestions and server restarts. The file can be the
+    Mercury database itself or a sidecar file. Each thread gets its own connection.
+
+    Hit/miss counters are kept in memory and written every `stats_flush_every` lookups, or with
+    the next write. If a `writer` (the server's `AnnotationWriter`) is given, writes are queued on
+    it instead of committed on the cache's own connection, so the server keeps a single writer.
+    """
+
+    def __init__(self, sqlite_db_path: str, writer=None, stats_flush_every: int = 256):
+        self.sqlite_db_path = sqlite_db_path
+        self.writer = writer
+        self.stats_flush_every = stats_flush_every
+        self.pending_stats: dict[Tuple[str, int], List[int]] = {} # (model, dimension) -> [hits, misses] not written yet
+        self.pending_lookups = 0
+        self.stats_lock = threading.Lock()
+        self.local = threading.local()
+        self.connections: List[sqlite3.Connection] = [] # of all threads, for `close`
+        self.connections_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        db = self.connect()
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache (\
+                text_hash BLOB, \
+                embedding_model_id TEXT, \
+                embedding_dimension INTEGER, \
+                embedding BLOB, \
+                PRIMARY KEY (text_hash, embedding_model_id, embedding_dimension)) WITHOUT ROWID"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache_stats (\
+                embedding_model_id TEXT, \
+                embedding_dimension INTEGER, \
+                hits INTEGER, \
+                misses INTEGER, \
+                PRIMARY KEY (embedding_model_id, embedding_dimension))"
+        )
+        db.commit()
+
+    def connect(self) -> sqlite3.Connection:
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.sqlite_db_path, timeout=60, check_same_thread=False) # the ingester may be writing to the same file
+            self.local.db = db
+            with self.connections_lock:
+                self.connections.append(db)
+        return db
+
+    def close(self):
+        """Write the pending counters and close the connections of every thread. The cache reconnects if it is used again."""
+        future = self.write([])
+        if future is not None:
+            future.result()
+        with self.connections_lock:
+            connections, self.connections = self.connections, []
+        for db in connections:
+            db.close()
+        self.local = threading.local()
+
+    def get_many(self, texts: List[str], embedding_model_id: str, embedding_dimension: int) -> List[np.ndarray | None]:
+        db = self.connect()
+        hashes = [text_hash(text) for text in texts]
+        found = {}
+        unique_hashes = list(set(hashes))
+        for i in range(0, len(unique_hashes), 500): # stay below SQLite's limit of bound parameters
+            part = unique_hashes[i : i + 500]
+            sql_cmd = "SELECT text_hash, embedding FROM embedding_cache WHERE embedding_model_id = ? AND embedding_dimension = ? AND text_hash IN ({0})".format(
+                ", ".join("?" for _ in part)
+            )
+            found.update(db.execute(sql_cmd, [embedding_model_id, int(embedding_dimension), *part]).fetchall())
+        results = [np.frombuffer(found[h], dtype=np.float32) if h in found else None for h in hashes]
+
+        hits = sum(result is not None for result in results)
+        misses = len(results) - hits
+        with self.stats_lock:
+            self.hits += hits
+            self.misses += misses
+            counts = self.pending_stats.setdefault((embedding_model_id, int(embedding_dimension)), [0, 0])
+            counts[0] += hits
+            counts[1] += misses
+            self.pending_lookups += len(results)
+            flush = self.pending_lookups >= self.stats_flush_every
+        if flush:
+            self.write([])
+        return results
+
+    def put_many(self, texts: List[str], embeddings: np.ndarray, embedding_model_id: str, embedding_dimension: int):
+        self.write([
+            [text_hash(text), embedding_model_id, int(embedding_dimension), np.asarray(embedding, dtype=np.float32).tobytes()]
+            for text, embedding in zip(texts, embeddings)
+        ])
+
+    def write(self, rows: List[list]):
+        """Store new entries, together with the pending hit/miss counters. Returns the writer's future, if there is a writer."""
+        with self.stats_lock:
+            stats = [[model_id, dimension, hits, misses] for (model_id, dimension), (hits, misses) in self.pending_stats.items()]
+            self.pending_stats = {}
+            self.pending_lookups = 0
+        if len(rows) == 0 and len(stats) == 0:
+            return
+        if self.writer is not None:
+            return self.writer.submit(self.insert, rows, stats) # committed by the writer thread, callers need not wait
+        else:
+            db = self.connect()
+            self.insert(db, rows, stats)
+            db.commit()
+
+    @staticmethod
+    def insert(db: sqlite3.Connection, rows: List[list], stats: List[list]):
+        db.executemany(
+            "INSERT OR IGNORE INTO embedding_cache (text_hash, embedding_model_id, embedding_dimension, embedding) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        db.executemany(
+            "INSERT INTO embedding_cache_stats (embedding_model_id, embedding_dimension, hits, misses) VALUES (?, ?, ?, ?) \
+             ON CONFLICT (embedding_model_id, embedding_dimension) DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses",
+            stats,
+        )
+
+    def embed(self, embedder, texts: List[str], embedding_dimension: int, batch_size: int = 12) -> np.ndarray:
+        """Same as `embedder.embed`, but only the texts not in the cache are sent to the model."""
+        embeddings = self.get_many(texts, embedder.name, embedding_dimension)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if len(missing) > 0:
+            missing_texts = [texts[i] for i in missing]
+            new_embeddings = embedder.embed(missing_texts, embedding_dimension=embedding_dimension, batch_size=batch_size)
+            self.put_many(missing_texts, new_embeddings, embedder.name, embedding_dimension)
+            for i, embedding in zip(missing, new_embeddings):
+                embeddings[i] = np.asarray(embedding, dtype=np.float32)
+        return np.stack(embeddings) if len(embeddings) > 0 else np.zeros((0, int(embedding_dimension)), dtype=np.float32)
+
+    def report(self) -> List[dict]:
+        """Size and lifetime hit rate of the cache per embedding model."""
+        db = self.connect()
+        sizes = db.execute(
+            "SELECT embedding_model_id, embedding_dimension, COUNT(*), SUM(length(embedding)) FROM embedding_cache GROUP BY embedding_model_id, embedding_dimension"
+        ).fetchall()
+        counters = {
+            (model_id, dimension): (hits, misses)
+            for model_id, dimension, hits, misses in db.execute("SELECT * FROM embedding_cache_stats").fetchall()
+        }
+        report = []
+        for model_id, dimension, entries, nbytes in sizes:
+            hits, misses = counters.get((model_id, dimension), (0, 0))
+            report.append({
+                "embedding_model_id": model_id,
+                "embedding_dimension": dimension,
+                "entries": entries,
+                "bytes": nbytes,
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses > 0 else 0.0,
+            })
+        return report
+
+    def prune(self, keep_model_ids: List[str]) -> int:
+        """Delete the entries of every embedding model not in `keep_model_ids`. Returns the number of deleted entries."""
+        db = self.connect()
+        placeholders = ", ".join("?" for _ in keep_model_ids)
+        deleted = db.execute(f"DELETE FROM embedding_cache WHERE embedding_model_id NOT IN ({placeholders})", keep_model_ids).rowcount
+        db.execute(f"DELETE FROM embedding_cache_stats WHERE embedding_model_id NOT IN ({placeholders})", keep_model_ids)
+        db.commit()
+        return deleted
+
+
+CacheKey = Tuple[str, int, str]  # (embedding_model_id, embedding_dimension, text)
+
+
+class QueryEmbeddingCache:
+    """A memory-capped LRU cache of query embeddings, keyed by (embedding_model_id, embedding_dimension, text).
+
+    If a persistent `EmbeddingCache` is given, in-memory misses are looked up there before the model
+    runs and new embeddings are written to it, so a restart does not start cold. `get_memory` never
+    touches SQLite. `get_stored` and `persist` do, so async code runs them in a thread.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, store: EmbeddingCache | None = None):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[CacheKey, np.ndarray] = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.store = store
+
+    @staticmethod
+    def entry_size(key: CacheKey, embedding: np.ndarray) -> int:
+        return embedding.nbytes + len(key[2])
+
+    def get(self, key: CacheKey) -> np.ndarray | None:
+        embedding = self.get_memory(key)
+        if embedding is None:
+            embedding = self.get_stored(key)
+        return embedding
+
+    def get_memory(self, key: CacheKey) -> np.ndarray | None:
+        """Look up the in-memory LRU only. A miss is counted by the `get_stored` that follows."""
+        with self.lock:
+            embedding = self.entries.get(key)
+            if embedding is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            return embedding
+
+    def get_stored(self, key: CacheKey) -> np.ndarray | None:
+        """Look up the persistent store, if any, after an in-memory miss."""
+        if self.store is not None:
+            embedding = self.store.get_many([key[2]], key[0], key[1])[0]
+            if embedding is not None:
+                with self.lock:
+                    self.persistent_hits += 1
+                self.put(key, embedding, persist=False)
+                return embedding
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def persist(self, key: CacheKey, embedding: np.ndarray):
+        if self.store is not None:
+            self.store.put_many([key[2]], [np.asarray(embedding, dtype=np.float32)], key[0], key[1])
+
+    def put(self, key: CacheKey, embedding: np.ndarray, persist: bool = True):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        if persist:
+            self.persist(key, embedding)
+        size = self.entry_size(key, embedding)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= self.entry_size(key, old)
+            self.entries[key] = embedding
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.nbytes -= self.entry_size(evicted_key, evicted)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.persistent_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "persistent_hits": self.persistent_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.persistent_hits) / lookups if lookups > 0 else 0.0,
+            }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(
+        description="Inspect or prune the persistent embedding cache",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("command", choices=["stats", "prune"])
+    parser.add_argument("sqlite_db_path", type=str, help="Path to the SQLite file holding the `embedding_cache` table")
+    parser.add_argument(
+        "--keep",
+        type=str,
+        nargs="+",
+        default=[],
+        help="For `prune`: the embedding_model_id's to keep. Entries of every other model are deleted.",
+    )
+    args = parser.parse_args()
+
+    cache = EmbeddingCache(args.sqlite_db_path)
+    if args.command == "stats":
+        print(json.dumps(cache.report(), indent=2))
+    elif args.command == "prune":
+        if len(args.keep) == 0:
+            parser.error("prune needs at least one --keep embedding_model_id")
+        print(f"Deleted {cache.prune(args.keep)} cached embeddings")
@@ -0,0 +1,246 @@
+"""A local embedding service: one process owns the embedding model and batches the requests of all its clients.
+
+Run `python3 embedding_service.py <embedding_model_id>` and point the server (`--embedding_service`)
+and the ingester (`--embedding_service`) at it, so several server workers share one copy of the model.
+"""
+
+import http.client
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+import numpy as np
+
+from embedding import BackgroundEmbedder
+
+
+class BatchQueue:
+    """Gathers the texts of concurrent requests into one `embed` call, on a single model thread.
+
+    The thread takes the first pending request, waits up to `batch_window` seconds for more
+    (or until `max_batch_size` texts), embeds the texts of all requests with the same embedding
+    dimension in one call, and hands each request back its own rows.
+    """
+
+    def __init__(self, embedder, batch_window: float = 0.005, max_batch_size: int = 256, model_batch_size: int = 32):
+        self.embedder = embedder
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.model_batch_size = model_batch_size
+        self.queue: queue.Queue = queue.Queue()
+        self.batches = 0
+        self.texts = 0
+        threading.Thread(target=self.run, name="embedding-batcher", daemon=True).start()
+
+    def submit(self, texts: List[str], embedding_dimension: int) -> Future:
+        future = Future()
+        self.queue.put((texts, embedding_dimension, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            num_texts = len(batch[0][0])
+            deadline = time.monotonic() + self.batch_window
+            while num_texts < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                num_texts += len(batch[-1][0])
+            for embedding_dimension in {request[1] for request in batch}:
+                self.embed([request for request in batch if request[1] == embedding_dimension], embedding_dimension)
+
+    def embed(self, requests: list, embedding_dimension: int):
+        texts = [text for request_texts, _, _ in requests for text in request_texts]
+        try:
+            embeddings = np.asarray(
+                self.embedder.embed(texts, embedding_dimension=embedding_dimension, batch_size=self.model_batch_size),
+                dtype=np.float32,
+            )
+        except Exception as e:
+            for _, _, future in requests:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.texts += len(texts)
+        start = 0
+        for request_texts, _, future in requests:
+            future.set_result(embeddings[start : start + len(request_texts)])
+            start += len(request_texts)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "mean_batch_size": self.texts / self.batches if self.batches > 0 else 0,
+            "pending": self.queue.qsize(),
+        }
+
+
+def make_handler(embedder: BackgroundEmbedder, batch_queue: BatchQueue, model_id: str):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, clients reuse their connection
+
+        def log_message(self, *args):
+            pass
+
+        def address_string(self) -> str:
+            return "local"  # Unix socket clients have no address
+
+        def send_body(self, status: int, body: bytes, content_type: str):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, status: int, payload: dict):
+            self.send_body(status, json.dumps(payload).encode(), "application/json")
+
+        def do_GET(self):
+            if self.path == "/info":
+                self.send_json(200, {"model": model_id, **embedder.stats(), "batching": batch_queue.stats()})
+            else:
+                self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/embed":
+                self.send_json(404, {"error": f"Unknown path {self.path}"})
+                return
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            try:
+                embeddings = batch_queue.submit(request["texts"], int(request["embedding_dimension"])).result()
+            except Exception as e:
+                self.send_json(500, {"error": repr(e)})
+                return
+            # raw little-endian float32, one row per text
+            self.send_body(200, embeddings.astype("<f4").tobytes(), "application/octet-stream")
+
+    return Handler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)  # left over from a previous run
+        super().server_bind()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class RemoteEmbedder:
+    """Same `embed` interface as `Embedder`, but the embeddings come from an embedding service.
+
+    `address` is `unix:/path/to/socket` or `http://host:port`. `name` is the model id the service
+    reports, so embedding caches keyed by model keep working.
+    """
+
+    def __init__(self, address: str, timeout: float = 600):
+        self.address = address
+        self.timeout = timeout
+        self.local = threading.local()  # one keep-alive connection per thread
+        self.name = self.info()["model"]
+
+    def connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            if self.address.startswith("unix:"):
+                connection = UnixHTTPConnection(self.address[len("unix:"):], timeout=self.timeout)
+            else:
+                host = self.address.removeprefix("http://").rstrip("/")
+                connection = http.client.HTTPConnection(host, timeout=self.timeout)
+            self.local.connection = connection
+        return connection
+
+    def request(self, method: str, path: str, body: bytes | None = None) -> bytes:
+        connection = self.connection()
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+        except (ConnectionError, http.client.HTTPException):
+            # the service may have closed an idle keep-alive connection. Retry once on a new one.
+            connection.close()
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"Embedding service {self.address} answered {response.status}: {data[:200]!r}")
+        return data
+
+    def info(self) -> dict:
+        return json.loads(self.request("GET", "/info"))
+
+    def embed(self, texts: List[str], embedding_dimension: int = 512, batch_size: int = 12) -> np.ndarray:
+        if len(texts) == 0:
+            return np.zeros((0, embedding_dimension), dtype=np.float32)
+        body = json.dumps({"texts": texts, "embedding_dimension": int(embedding_dimension)}).encode()
+        embeddings = np.frombuffer(self.request("POST", "/embed", body), dtype="<f4")
+        return embeddings.reshape(len(texts), -1)
+
+    def is_ready(self) -> bool:
+        try:
+            return self.info()["ready"]
+        except (OSError, RuntimeError, http.client.HTTPException):
+            return False
+
+    def stats(self) -> dict:
+        try:
+            return {"service": self.address, **self.info()}
+        except (OSError, RuntimeError, http.client.HTTPException) as e:
+            return {"service": self.address, "ready": False, "error": repr(e)}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("embedding_model_id", type=str, help="The model to serve. Use the embedding_model_id the database was ingested with")
+    parser.add_argument("--socket", type=str, default=None, help="Listen on this Unix domain socket instead of TCP")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--batch_window_ms", type=float, default=5, help="How long to wait for more requests before running the model")
+    parser.add_argument("--max_batch_size", type=int, default=256, help="Run the model right away once this many texts are pending")
+    parser.add_argument("--model_batch_size", type=int, default=32, help="Batch size of the model's forward pass. Only effective to sentence-transformers embedders")
+    parser.add_argument("--openai_max_concurrency", type=int, default=8)
+    parser.add_argument("--openai_tokens_per_minute", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    embedder = BackgroundEmbedder(
+        args.embedding_model_id,
+        openai_max_concurrency=args.openai_max_concurrency,
+        openai_tokens_per_minute=args.openai_tokens_per_minute,
+    )
+    batch_queue = BatchQueue(
+        embedder, batch_window=args.batch_window_ms / 1000, max_batch_size=args.max_batch_size, model_batch_size=args.model_batch_size
+    )
+    handler = make_handler(embedder, batch_queue, args.embedding_model_id)
+    if args.socket is not None:
+        server = ThreadingUnixHTTPServer(args.socket, handler)
+        print(f"Serving {args.embedding_model_id} on unix:{args.socket}")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        print(f"Serving {args.embedding_model_id} on http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -1,6 +1,11 @@
+import itertools
 import json
+import os
+import queue
+import threading
+import time
 from enum import Enum
-from typing import Dict, List, Literal, Tuple, TypedDict
+from typing import Dict, Iterable, Iterator, List, Literal, Tuple, TypedDict
 
 import sqlite3, sqlite_vec
 import spacy 
@@ -12,56 +17,97 @@ from tqdm.auto import tqdm
 
 import struct
 
+from database import DOCUMENTS_TABLE, SAMPLE_HASHES_TABLE, migrate, pack_offsets, sample_hash
+from embedding import EmbeddingCache, Embedder
+from embedding_service import RemoteEmbedder
+from search import align_samples, load_sample_matrices
+
 load_dotenv()
 
 def serialize_f32(vector: List[float]) -> bytes:
     """serializes a list of floats into a compact "raw bytes" format"""
     return struct.pack("%sf" % len(vector), *vector)
 
-class Embedder: 
-    def __init__(self, name: Literal['bge-small-en-v1.5', 'openai', 'all-mpnet-base-v2', 'multi-qa-mpnet-base-dot-v1']) -> None:
-        self.name = name 
-        self.use_sentence_transformers = False
-        if name in ['bge-small-en-v1.5']:
-            from sentence_transformers import SentenceTransformer
-            self.model = SentenceTransformer(f'BAAI/{name}')
-            self.use_sentence_transformers = True
-        elif 'openai' in name:
-            from openai import OpenAI
-            self.model = OpenAI()
-        elif name in ['multi-qa-mpnet-base-dot-v1', 'all-mpnet-base-v2']:
-            from sentence_transformers import SentenceTransformer
-            self.model = SentenceTransformer(f'sentence-transformers/{name}')
-            self.use_sentence_transformers = True
-        else: 
-            print (f"Unsupported embedder {name}. Please check. ")
-            exit() 
-    
-    def embed(self, texts: List[str], embedding_dimension: int= 512,  batch_size:int = 12) -> np.ndarray:
-        """The function that takes a list of strings and returns a numpy array of their embeddings.
-        """
-        if self.use_sentence_transformers:
-            return self.model.encode(texts, batch_size=batch_size, normalize_embeddings=True)
-        # elif self.name == 'bge-m3':
-        #     return self.model.encode(texts, batch_size=batch_size, max_length=512)['dense_vecs']
-        elif "openai" in self.name:
-            openai_model_id = self.name.split("/")[-1]
-            response  = self.model.embeddings.create(input=texts, model=openai_model_id, dimensions=int(embedding_dimension))
-            return np.array([item.embedding for item in response.data])
-        else:
-            # return dummy embeddings
-            print (f"Returning dummy embeddings")
-            return np.random.rand(len(texts), embedding_dimension)
+class Sample(TypedDict):
+    sample_id: int # assigned by `chunk_batches` once the sample is known not to be a duplicate
+    texts: Dict[str, str] # text_type -> document text
+    json_meta: str | None # the columns other than the ingestion columns, as a JSON string
+    record_index: int # position of the sample in the ingestion file
+    content_hash: bytes # see `database.sample_hash`
+
+class IngestBatch(TypedDict):
+    rows: List[list] # rows of the chunks table
+    samples: List[Sample] # samples whose chunks are all in `rows`
+    documents: List[list] # rows of the documents table for `samples`
+    embeddings: np.ndarray | None # one per row, filled by the embedding stage
+
+class StageStats:
+    """Timing of one stage of `Ingester.ingest_pipelined`. Time blocked on a queue counts as waiting, not busy."""
+    def __init__(self, name: str):
+        self.name = name
+        self.processed = 0 # samples for the read stage, chunks for the others
+        self.waiting = 0.0
+        self.elapsed = 0.0
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.started
+
+    def iter_queue(self, in_queue: queue.Queue) -> Iterator:
+        while True:
+            wait_start = time.perf_counter()
+            item = in_queue.get()
+            self.waiting += time.perf_counter() - wait_start
+            if item is None:
+                return
+            yield item
+
+    def report(self) -> str:
+        busy = max(self.elapsed - self.waiting, 1e-9)
+        return f"{self.name:<6} {self.processed:>9}  {busy:>8.1f}  {self.waiting:>11.1f}  {self.processed / busy:.1f}"
+
+def iter_json_array(f, read_size: int = 1 << 20) -> Iterator[Dict]:
+    """Stream the items of a top-level JSON array from a file object without loading the whole file."""
+    decoder = json.JSONDecoder()
+    buffer = f.read(read_size).lstrip()
+    if not buffer.startswith("["):
+        raise Exception("Expected a JSON array of records")
+    pos, eof = 1, False
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        try:
+            if pos >= len(buffer):
+                raise json.JSONDecodeError("Need more data", buffer, pos)
+            item, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            more = f.read(read_size)  # the item continues beyond the buffer
+            eof = more == ""
+            buffer, pos = buffer[pos:] + more, 0
+            continue
+        yield item
 
 class Chunker: 
-    def __init__(self):
+    def __init__(self, batch_size: int = 64, n_process: int = 1):
         nlp = spacy.load("en_core_web_sm", exclude=["tok2vec",'tagger','parser','ner', 'attribute_ruler', 'lemmatizer'])
         nlp.add_pipe("sentencizer")
         self.nlp = nlp
+        self.batch_size = batch_size
+        self.n_process = n_process
 
-    def chunk(self, text: str) -> List[List[str]]:
+    def chunk(self, text: str) -> List[str]:
         return [sent.text for sent in self.nlp(text).sents]
-        # return [[sent.text for sent in doc.sents ] for doc in self.nlp.pipe(texts)]
+
+    def chunk_many(self, texts: Iterable[str]) -> Iterator[List[str]]:
+        """Stream the chunks of many texts, in input order, sentencizing in `n_process` processes."""
+        for doc in self.nlp.pipe(texts, batch_size=self.batch_size, n_process=self.n_process):
+            yield [sent.text for sent in doc.sents]
 
 class Ingester:
     def __init__(
@@ -74,6 +120,20 @@ class Ingester:
         sqlite_db_path: str = "./mercury.sqlite",
         ingest_column_1: str = "source",
         ingest_column_2: str = "summary",
+        align_top_k: int = 0,
+        batch_size: int = 1024,
+        embed_batch_size: int = 32,
+        chunk_batch_size: int = 64,
+        chunk_n_process: int = 1,
+        read_batch_size: int = 1000,
+        pipeline: bool = False,
+        queue_size: int = 4,
+        use_embedding_cache: bool = True,
+        embedding_cache_path: str | None = None,
+        openai_max_concurrency: int = 8,
+        openai_tokens_per_minute: int = 1_000_000,
+        quantization: Literal["none", "int8", "binary"] = "none",
+        embedding_service: str | None = None,
     ):
         self.file_to_ingest = file_to_ingest
         self.overwrite_data = overwrite_data
@@ -85,10 +145,30 @@ class Ingester:
 
         self.ingest_column_1 = ingest_column_1
         self.ingest_column_2 = ingest_column_2
+        self.align_top_k = align_top_k
+        self.quantization = quantization
+        if quantization == "binary" and self.embedding_dimension % 8 != 0:
+            raise Exception(f"Binary quantization needs an embedding dimension divisible by 8, got {self.embedding_dimension}")
+        self.batch_size = batch_size
+        self.embed_batch_size = embed_batch_size
+        self.read_batch_size = read_batch_size
+        self.pipeline = pipeline
+        self.queue_size = queue_size
+        self.text_types = [ingest_column_1, ingest_column_2]
 
-        self.chunker = Chunker()
-        self.embedder = Embedder(embedding_model_id)
-        self.text = {}
+        self.chunker = Chunker(batch_size=chunk_batch_size, n_process=chunk_n_process)
+        if embedding_service is not None:
+            self.embedder = RemoteEmbedder(embedding_service)
+            if self.embedder.name != embedding_model_id:
+                raise Exception(f"The embedding service at {embedding_service} serves {self.embedder.name}, not {embedding_model_id}")
+        else:
+            self.embedder = Embedder(
+                embedding_model_id, openai_max_concurrency=openai_max_concurrency, openai_tokens_per_minute=openai_tokens_per_minute
+            )
+        # the cache is a second copy of every chunk embedding, so by default it lives in a sidecar file and not in the database
+        if embedding_cache_path is None:
+            embedding_cache_path = os.path.splitext(sqlite_db_path)[0] + ".embcache.sqlite"
+        self.embedding_cache = EmbeddingCache(embedding_cache_path) if use_embedding_cache else None
 
     def prepare_db(self):
         self.db = sqlite3.connect(self.sqlite_db_path)
@@ -103,24 +183,61 @@ class Ingester:
             if answer == "YES":
                 self.db.execute("DROP TABLE IF EXISTS chunks")
                 self.db.execute("DROP TABLE IF EXISTS embeddings")
+                self.db.execute("DROP TABLE IF EXISTS embeddings_quantized")
                 self.db.execute("DROP TABLE IF EXISTS config")
                 self.db.execute("DROP TABLE IF EXISTS annotations")
+                self.db.execute("DROP TABLE IF EXISTS annotation_changes")
                 self.db.execute("DROP TABLE IF EXISTS leaderboard")
                 self.db.execute("DROP TABLE IF EXISTS users")
+                self.db.execute("DROP TABLE IF EXISTS chunk_alignments")
+                self.db.execute("DROP TABLE IF EXISTS sample_meta")
+                self.db.execute("DROP TABLE IF EXISTS sample_hashes")
+                self.db.execute("DROP TABLE IF EXISTS documents")
                 self.db.commit()
 
         self.db.execute(
             "CREATE TABLE IF NOT EXISTS chunks (chunk_id INTEGER PRIMARY KEY, text TEXT, text_type TEXT, sample_id INTEGER, char_offset INTEGER, chunk_offset INTEGER)"
         )
         self.db.execute(
-            f"CREATE VIRTUAL TABLE embeddings USING vec0(embedding float[{self.embedding_dimension}])"
+            "CREATE INDEX IF NOT EXISTS chunks_sample_id ON chunks (sample_id, text_type, chunk_offset)"
         )
+        self.db.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS embeddings USING vec0(embedding float[{self.embedding_dimension}])"
+        )
+        if self.quantization != "none":
+            # a compact copy of `embeddings` for the coarse search. Full-precision vectors stay in `embeddings` for rescoring.
+            column_type = "int8" if self.quantization == "int8" else "bit"
+            self.db.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS embeddings_quantized USING vec0(embedding {column_type}[{self.embedding_dimension}])"
+            )
         self.db.execute(
             "CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT)"
         )
         self.db.execute(
             "CREATE TABLE IF NOT EXISTS sample_meta (sample_id INTEGER PRIMARY KEY, json_meta TEXT)"
         )
+        self.db.execute(DOCUMENTS_TABLE)
+        self.db.execute(SAMPLE_HASHES_TABLE)
+        migrate(self.db) # among others, hashes the samples of databases ingested before `sample_hashes` existed
+
+        # Appending to existing data: the embeddings must come from the same model, and ids continue from the current max.
+        configs = dict(self.db.execute("SELECT key, value FROM config").fetchall())
+        self.next_chunk_id = self.db.execute("SELECT COALESCE(MAX(chunk_id) + 1, 0) FROM chunks").fetchone()[0]
+        if self.next_chunk_id > 0 and (
+            configs.get("embedding_model_id") != self.embedding_model_id
+            or int(configs.get("embedding_dimension", -1)) != int(self.embedding_dimension)
+            or configs.get("quantization", "none") != self.quantization
+        ):
+            raise Exception(
+                f"The database `{self.sqlite_db_path}` already holds embeddings of {configs.get('embedding_model_id')} ({configs.get('embedding_dimension')} dimensions, quantization {configs.get('quantization', 'none')}). Use the same embedding settings to append, or --overwrite_data."
+            )
+        self.next_sample_id = self.db.execute(
+            "SELECT MAX(COALESCE((SELECT MAX(sample_id) + 1 FROM chunks), 0), COALESCE((SELECT MAX(sample_id) + 1 FROM sample_meta), 0), \
+             COALESCE((SELECT MAX(sample_id) + 1 FROM documents), 0))"
+        ).fetchone()[0]
+        self.first_sample_id = self.next_sample_id
+        self.checkpoint = json.loads(configs["ingest_checkpoint"]) if "ingest_checkpoint" in configs else None
+        self.skipped_samples = 0
 
         # Below commented by Forrest on 2024-09-28 because `users` is not used in ingestion but annotation
         # `users` initialization moved to `database.py`
@@ -136,70 +253,311 @@ class Ingester:
             "INSERT OR REPLACE INTO config (key, value) VALUES ('embedding_dimension', ?)",
             [self.embedding_dimension],
         )
+        self.db.execute(
+            "INSERT OR REPLACE INTO config (key, value) VALUES ('quantization', ?)",
+            [self.quantization],
+        )
         
         self.db.commit()
 
-    def load_data_for_ingestion(self) -> Tuple[List[str], List[str]]:
-        # if file_to_ingest ends with JSONL, load it as JSONL
-        if self.file_to_ingest.endswith("jsonl"):
-            df = pandas.read_json(self.file_to_ingest, lines=True)
-        elif self.file_to_ingest.endswith("json"):
-            df = pandas.read_json(self.file_to_ingest)
-        elif self.file_to_ingest.endswith("csv"):
-            df = pandas.read_csv(self.file_to_ingest)
-        else:
-            raise Exception(f"Unsupported file format in {self.file_to_ingest}")
-        
-        df.columns = df.columns.str.lower()
-
-        sources: List[str] = df[self.ingest_column_1].tolist()
-        summaries: List[str] = df[self.ingest_column_2].tolist()
-
-        self.text[self.ingest_column_1] = sources
-        self.text[self.ingest_column_2] = summaries
-
-        df_other_columns = df.drop(columns=[self.ingest_column_1, self.ingest_column_2])
-        if len(df_other_columns.columns) > 0:
-            sample_ids = range(0, len(sources))
-            json_meta = [row.to_json() for _, row in df_other_columns.iterrows()]
-            cmd = "INSERT INTO sample_meta (sample_id, json_meta) VALUES (?, ?)"
-            self.db.executemany(cmd, zip(sample_ids, json_meta))
-            self.db.commit()
-    
-    def ingest(self):
-        """Chunk the data, embed the chunks, and save to the database."""
+    def iter_records(self) -> Iterator[Tuple[Dict, str | None]]:
+        """Stream the records of the ingestion file as (record, json_meta) without loading the whole file.
 
-        global_chunk_id = 0 # the id of the chunk in tables, starting from 1
-        for text_type, docs in self.text.items():
-            print (f"Processing {text_type}")
-            for sample_id in tqdm(range(0, len(docs)), desc="Sample"): # simple, just chunk and embed one doc each time
-                char_offset = 0
-                chunks = self.chunker.chunk(docs[sample_id])
-                embeddings = self.embedder.embed(chunks, embedding_dimension=self.embedding_dimension)
-                for chunk_offset, chunk_text in enumerate(chunks):
-                    # print ([global_chunk_id, chunk_text, text_type, sample_id+1, char_offset, chunk_offset])
-                    self.db.execute(
-                        "INSERT INTO chunks (chunk_id, text, text_type, sample_id, char_offset, chunk_offset) VALUES (?, ?, ?, ?, ?, ?)",
-                        [global_chunk_id, chunk_text, text_type, sample_id, char_offset, chunk_offset]
-                    )
-                    self.db.commit()
-                    self.db.execute(
-                        "INSERT INTO embeddings (rowid, embedding) VALUES (?, ?)",
-                        [global_chunk_id, serialize_f32(embeddings[chunk_offset])]
-                    )
-                    self.db.commit()
+        Column names are lowercased. `json_meta` holds the columns other than the two ingestion columns, or None if there are none.
+        """
+        ingest_columns = [self.ingest_column_1, self.ingest_column_2]
+        if self.file_to_ingest.endswith("csv"):
+            for df in pandas.read_csv(self.file_to_ingest, chunksize=self.read_batch_size):
+                df.columns = df.columns.str.lower()
+                df_other_columns = df.drop(columns=ingest_columns)
+                records = df[ingest_columns].to_dict(orient="records")
+                if len(df_other_columns.columns) > 0:
+                    json_meta = [line for line in df_other_columns.to_json(orient="records", lines=True).split("\n") if line != ""]
+                else:
+                    json_meta = [None] * len(records)
+                yield from zip(records, json_meta)
+            return
+
+        with open(self.file_to_ingest) as f:
+            # if file_to_ingest ends with JSONL, load it as JSONL
+            if self.file_to_ingest.endswith("jsonl"):
+                records = (json.loads(line) for line in f if line.strip() != "")
+            elif self.file_to_ingest.endswith("json"):
+                records = iter_json_array(f)
+            else:
+                raise Exception(f"Unsupported file format in {self.file_to_ingest}")
+            for record in records:
+                record = {key.lower(): value for key, value in record.items()}
+                other = {key: value for key, value in record.items() if key not in ingest_columns}
+                yield record, json.dumps(other) if len(other) > 0 else None
+
+    def file_signature(self) -> List:
+        """Identifies the ingestion file in checkpoints. A modified file does not match its old checkpoint."""
+        stat = os.stat(self.file_to_ingest)
+        return [os.path.abspath(self.file_to_ingest), stat.st_size, stat.st_mtime_ns]
 
+    def read_batches(self) -> Iterator[List[Sample]]:
+        """Stream the samples of the ingestion file in batches of at most `read_batch_size`.
+
+        If the last checkpoint was written while ingesting the same, unmodified file, the records
+        it had already read are skipped. Sample ids and duplicates are left to `chunk_batches`.
+        """
+        records = enumerate(self.iter_records())
+        if self.checkpoint is not None and self.checkpoint["file"] == self.file_signature():
+            print (f"Resuming {self.file_to_ingest} after record {self.checkpoint['records_read']}")
+            records = itertools.islice(records, self.checkpoint["records_read"], None)
+
+        while True:
+            part = list(itertools.islice(records, self.read_batch_size))
+            if len(part) == 0:
+                break
+            yield [
+                {
+                    "sample_id": -1,
+                    "texts": {text_type: record[text_type] for text_type in self.text_types},
+                    "json_meta": json_meta,
+                    "record_index": record_index,
+                    "content_hash": b"",
+                }
+                for record_index, (record, json_meta) in part
+            ]
+
+    def chunk_batches(self, samples: Iterable[Sample]) -> Iterator[IngestBatch]:
+        """Chunk a stream of samples and group the chunks into batches of at least `batch_size` chunks (rounded up to whole samples).
+
+        A sample whose documents (as stored in `documents`) and metadata are the same as those of a
+        sample already in the database, or of an earlier one in this run, is skipped. The others get
+        sample ids in file order, continuing from the largest one in the database.
+        """
+        samples, samples_to_chunk = itertools.tee(samples)
+        chunked = self.chunker.chunk_many(
+            sample["texts"][text_type] for sample in samples_to_chunk for text_type in self.text_types
+        )
+        db = sqlite3.connect(self.sqlite_db_path) # own connection because this may run in the chunking thread of --pipeline
+        seen_hashes = set() # of the samples kept in this run, which may not be committed yet
+
+        sample_id = self.next_sample_id
+        global_chunk_id = self.next_chunk_id # the id of the chunk in tables, starting from 0 for a new database
+        batch = [] # rows of the chunks table waiting to be embedded and written
+        batch_samples = [] # samples whose chunks are all in `batch`
+        batch_documents = [] # rows of the documents table of `batch_samples`
+        for sample in samples:
+            chunks = {text_type: next(chunked) for text_type in self.text_types}
+            # the text the char_offsets count in, as served to annotators
+            documents = {text_type: " ".join(chunks[text_type]) for text_type in self.text_types}
+            content_hash = sample_hash(documents, sample["json_meta"])
+            if content_hash in seen_hashes or db.execute(
+                "SELECT 1 FROM sample_hashes WHERE content_hash = ?", [content_hash]
+            ).fetchone() is not None:
+                self.skipped_samples += 1
+                continue
+            seen_hashes.add(content_hash)
+            sample = {**sample, "sample_id": sample_id, "content_hash": content_hash}
+            sample_id += 1
+
+            for text_type in self.text_types:
+                char_offset = 0
+                char_offsets = []
+                for chunk_offset, chunk_text in enumerate(chunks[text_type]):
+                    batch.append([global_chunk_id, chunk_text, text_type, sample["sample_id"], char_offset, chunk_offset])
+                    char_offsets.append(char_offset)
                     char_offset += len(chunk_text) + 1 # +1 for the space between sentences. 
                     global_chunk_id += 1
+                batch_documents.append([sample["sample_id"], text_type, documents[text_type], pack_offsets(char_offsets)])
+            batch_samples.append(sample)
+            if len(batch) >= self.batch_size:
+                yield {"rows": batch, "samples": batch_samples, "documents": batch_documents, "embeddings": None}
+                batch, batch_samples, batch_documents = [], [], []
+        if len(batch_samples) > 0:
+            yield {"rows": batch, "samples": batch_samples, "documents": batch_documents, "embeddings": None}
+        db.close()
+
+    def embed_batch(self, batch: IngestBatch) -> IngestBatch:
+        texts = [row[1] for row in batch["rows"]]
+        if self.embedding_cache is not None:
+            batch["embeddings"] = self.embedding_cache.embed(
+                self.embedder, texts, embedding_dimension=self.embedding_dimension, batch_size=self.embed_batch_size
+            )
+        else:
+            batch["embeddings"] = self.embedder.embed(
+                texts, embedding_dimension=self.embedding_dimension, batch_size=self.embed_batch_size
+            )
+        return batch
+
+    def write_batch(self, batch: IngestBatch):
+        """Insert a batch into `chunks`, `documents`, `embeddings` and `sample_meta` in one transaction."""
+        self.db.executemany(
+            "INSERT INTO sample_meta (sample_id, json_meta) VALUES (?, ?)",
+            [[sample["sample_id"], sample["json_meta"]] for sample in batch["samples"] if sample["json_meta"] is not None],
+        )
+        self.db.executemany(
+            "INSERT INTO chunks (chunk_id, text, text_type, sample_id, char_offset, chunk_offset) VALUES (?, ?, ?, ?, ?, ?)",
+            batch["rows"],
+        )
+        self.db.executemany(
+            "INSERT INTO documents (sample_id, text_type, text, chunk_offsets) VALUES (?, ?, ?, ?)",
+            batch["documents"],
+        )
+        self.db.executemany(
+            "INSERT INTO embeddings (rowid, embedding) VALUES (?, ?)",
+            [[row[0], serialize_f32(embedding)] for row, embedding in zip(batch["rows"], batch["embeddings"])],
+        )
+        if self.quantization != "none":
+            quantize = "vec_quantize_int8(?, 'unit')" if self.quantization == "int8" else "vec_quantize_binary(?)"
+            self.db.executemany(
+                f"INSERT INTO embeddings_quantized (rowid, embedding) VALUES (?, {quantize})",
+                [[row[0], serialize_f32(embedding)] for row, embedding in zip(batch["rows"], batch["embeddings"])],
+            )
+        self.db.executemany(
+            "INSERT OR IGNORE INTO sample_hashes (content_hash, sample_id) VALUES (?, ?)",
+            [[sample["content_hash"], sample["sample_id"]] for sample in batch["samples"]],
+        )
+        # the checkpoint commits together with the batch, so a crash loses at most the batches not yet on disk, and resuming redoes them
+        last_sample = batch["samples"][-1]
+        self.db.execute(
+            "INSERT OR REPLACE INTO config (key, value) VALUES ('ingest_checkpoint', ?)",
+            [json.dumps({
+                "file": self.file_signature(),
+                "records_read": last_sample["record_index"] + 1,
+                "last_sample_id": last_sample["sample_id"],
+                "last_chunk_id": batch["rows"][-1][0] if len(batch["rows"]) > 0 else None,
+            })],
+        )
+        self.db.commit()
+
+    def ingest(self):
+        """Chunk the data, embed the chunks, and save to the database.
+
+        Samples are streamed from the ingestion file, so memory stays flat regardless of its size.
+        Chunks of many samples are embedded and written together in batches of at least
+        `batch_size` chunks (rounded up to whole samples), with one commit per batch.
+        """
+        if self.pipeline:
+            return self.ingest_pipelined()
+
+        pragmas = self.begin_bulk_load()
+        samples = (sample for batch in self.read_batches() for sample in batch)
+        with tqdm(desc="Ingest", unit="chunk") as progress:
+            for batch in self.chunk_batches(samples):
+                self.write_batch(self.embed_batch(batch))
+                progress.update(len(batch["rows"]))
+        self.close_embedding_cache()
+        self.end_bulk_load(pragmas)
+
+    def ingest_pipelined(self):
+        """Same as `ingest`, but reading, chunking, embedding and writing run concurrently.
+
+        The stages run in their own threads (writing stays in the calling thread, which owns the
+        database connection) and are connected by queues of at most `queue_size` batches.
+        Per-stage throughput and queue depths are reported, so the bottleneck is visible.
+        """
+        read_queue, chunk_queue, embed_queue = (queue.Queue(maxsize=self.queue_size) for _ in range(3))
+        stats = {name: StageStats(name) for name in ["read", "chunk", "embed", "write"]}
+        errors = []
+
+        def run_stage(stage: StageStats, items: Iterable, out_queue: queue.Queue, count):
+            stage.start()
+            try:
+                for item in items:
+                    stage.processed += count(item)
+                    wait_start = time.perf_counter()
+                    out_queue.put(item)
+                    stage.waiting += time.perf_counter() - wait_start
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                out_queue.put(None) # tell the next stage that there is nothing more
+                stage.stop()
+
+        count_rows = lambda batch: len(batch["rows"])
+        samples = (sample for batch in stats["chunk"].iter_queue(read_queue) for sample in batch)
+        threads = [
+            threading.Thread(target=run_stage, args=(stats["read"], self.read_batches(), read_queue, len), daemon=True),
+            threading.Thread(target=run_stage, args=(stats["chunk"], self.chunk_batches(samples), chunk_queue, count_rows), daemon=True),
+            threading.Thread(
+                target=run_stage,
+                args=(stats["embed"], map(self.embed_batch, stats["embed"].iter_queue(chunk_queue)), embed_queue, count_rows),
+                daemon=True,
+            ),
+        ]
+
+        pragmas = self.begin_bulk_load()
+        for thread in threads:
+            thread.start()
+        stats["write"].start()
+        with tqdm(desc="Ingest", unit="chunk") as progress:
+            for batch in stats["write"].iter_queue(embed_queue):
+                self.write_batch(batch)
+                stats["write"].processed += len(batch["rows"])
+                progress.update(len(batch["rows"]))
+                progress.set_postfix(queued_read=read_queue.qsize(), queued_chunk=chunk_queue.qsize(), queued_embed=embed_queue.qsize())
+        stats["write"].stop()
+        self.close_embedding_cache()
+        self.end_bulk_load(pragmas)
+
+        if len(errors) > 0:
+            raise errors[0]
+        print ("Stage  processed  busy (s)  waiting (s)  throughput (per busy second)")
+        for stage in stats.values():
+            print (stage.report())
+
+    def close_embedding_cache(self):
+        # the cache may share the database file (--embedding_cache_path). Do not leave its connections open on it after ingestion.
+        if self.embedding_cache is not None:
+            self.embedding_cache.close()
+
+    def begin_bulk_load(self) -> Dict[str, str]:
+        """Make commits cheaper while loading. Returns the previous settings for `end_bulk_load`.
+
+        WAL with `synchronous = NORMAL` does not sync on every commit, yet a crash or power loss
+        cannot corrupt the file, which also holds the annotations. At worst it rolls back the last
+        few commits, checkpoints included.
+
+        The file is left in WAL mode afterwards: the server opens it in WAL anyway, and switching
+        back would fail while any other connection (e.g. a running server) has it open.
+        """
+        pragmas = {
+            "synchronous": self.db.execute("PRAGMA synchronous").fetchone()[0],
+        }
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        return pragmas
+
+    def end_bulk_load(self, pragmas: Dict[str, str]):
+        self.db.execute(f"PRAGMA synchronous = {pragmas['synchronous']}")
+
+    def align(self):
+        """Precompute the top-k cross-document neighbours of every chunk, so whole-sentence selections need no search at request time."""
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS chunk_alignments (chunk_id INTEGER, neighbor_chunk_id INTEGER, score REAL, PRIMARY KEY (chunk_id, neighbor_chunk_id)) WITHOUT ROWID"
+        )
+        sample_ids = [
+            row[0]
+            for row in self.db.execute(
+                "SELECT DISTINCT sample_id FROM chunks WHERE sample_id >= ? ORDER BY sample_id", [self.first_sample_id]
+            ).fetchall()
+        ]
+        for sample_id in tqdm(sample_ids, desc="Align"):
+            rows = align_samples(load_sample_matrices(self.db, sample_id), self.align_top_k)
+            self.db.executemany(
+                "INSERT OR REPLACE INTO chunk_alignments (chunk_id, neighbor_chunk_id, score) VALUES (?, ?, ?)", rows
+            )
+        self.db.execute(
+            "INSERT OR REPLACE INTO config (key, value) VALUES ('align_top_k', ?)",
+            [self.align_top_k],
+        )
+        self.db.commit()
 
     def main(self):  # or become __call__
         self.prepare_db()
-        self.load_data_for_ingestion()
         self.ingest()
+        if self.skipped_samples > 0:
+            print (f"Skipped {self.skipped_samples} samples that are already in the database or repeated in the file")
+        if self.align_top_k > 0:
+            self.align()
 
 if __name__ == "__main__":
     import argparse
-    import os
 
     def get_env_id_value(env_name: str) -> int | None:
         env = os.environ.get(env_name, None)
@@ -215,7 +573,7 @@ if __name__ == "__main__":
         "--overwrite_data",
         action="store_true",
         default=False,
-        help="If True, overwrite the data store in database. If False (default), append to the existing data.",
+        help="If True, overwrite the data store in database. If False (default), append to the existing data: ids continue from the current max, samples already in the database are skipped, and an interrupted ingestion of the same file resumes from its last checkpoint.",
     )
     parser.add_argument(
         "--embedding_model_id",
@@ -248,6 +606,100 @@ if __name__ == "__main__":
         help="The name of the 2nd column to ingest",
     )
 
+    parser.add_argument(
+        "--align_top_k",
+        type=int,
+        default=0,
+        help="If > 0, precompute this many cross-document neighbours for every chunk so that whole-sentence selections are answered without a vector search. Use at least 5, the number of highlights the server returns.",
+    )
+
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1024,
+        help="Number of chunks (rounded up to whole documents) embedded and written to the database per batch. Each batch is one transaction.",
+    )
+    parser.add_argument(
+        "--embed_batch_size",
+        type=int,
+        default=32,
+        help="Batch size of the embedding model's forward pass. Only effective to sentence-transformers embedders.",
+    )
+
+    parser.add_argument(
+        "--chunk_batch_size",
+        type=int,
+        default=64,
+        help="Number of documents per spaCy `nlp.pipe` batch when splitting sentences",
+    )
+    parser.add_argument(
+        "--chunk_n_process",
+        type=int,
+        default=1,
+        help="Number of processes splitting sentences with spaCy",
+    )
+
+    parser.add_argument(
+        "--read_batch_size",
+        type=int,
+        default=1000,
+        help="Number of samples read from the ingestion file at a time",
+    )
+
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        default=False,
+        help="Run reading, sentence splitting, embedding and writing as concurrent stages connected by bounded queues, and report per-stage throughput",
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=4,
+        help="Maximum number of batches waiting between two stages of --pipeline",
+    )
+
+    parser.add_argument(
+        "--no_embedding_cache",
+        action="store_true",
+        default=False,
+        help="Do not look up or store chunk embeddings in the persistent `embedding_cache` table",
+    )
+    parser.add_argument(
+        "--embedding_cache_path",
+        type=str,
+        default=None,
+        help="SQLite file holding the `embedding_cache` table. Defaults to `<sqlite_db_path without extension>.embcache.sqlite` next to the database. It stores every chunk embedding a second time, so pointing it at the database file itself makes that file much bigger. Run `python3 embedding.py stats <file>` to see its size and hit rate.",
+    )
+
+    parser.add_argument(
+        "--openai_max_concurrency",
+        type=int,
+        default=8,
+        help="Number of embedding requests kept in flight. Only effective to OpenAI embedders.",
+    )
+    parser.add_argument(
+        "--openai_tokens_per_minute",
+        type=int,
+        default=1_000_000,
+        help="Tokens-per-minute budget of the embedding requests. Set it to your quota. Only effective to OpenAI embedders.",
+    )
+
+    parser.add_argument(
+        "--quantization",
+        type=str,
+        default="none",
+        choices=["none", "int8", "binary"],
+        help="Also store int8 or binary quantized embeddings. The server then searches the compact vectors first and rescores the top candidates with the full-precision ones. The float32 embeddings are kept, so the database grows by the quantized copy.",
+    )
+
+    parser.add_argument(
+        "--embedding_service",
+        type=str,
+        default=None,
+        help="Embed through a running embedding service (embedding_service.py) at unix:/path/to/socket or http://host:port instead of loading the model here. It must serve --embedding_model_id.",
+    )
+
     args = parser.parse_args()
 
     print("Ingesting data")
@@ -259,6 +711,20 @@ if __name__ == "__main__":
         sqlite_db_path=args.sqlite_db_path,
         ingest_column_1=args.ingest_column_1,
         ingest_column_2=args.ingest_column_2,
+        align_top_k=args.align_top_k,
+        batch_size=args.batch_size,
+        embed_batch_size=args.embed_batch_size,
+        chunk_batch_size=args.chunk_batch_size,
+        chunk_n_process=args.chunk_n_process,
+        read_batch_size=args.read_batch_size,
+        pipeline=args.pipeline,
+        queue_size=args.queue_size,
+        use_embedding_cache=not args.no_embedding_cache,
+        embedding_cache_path=args.embedding_cache_path,
+        openai_max_concurrency=args.openai_max_concurrency,
+        openai_tokens_per_minute=args.openai_tokens_per_minute,
+        quantization=args.quantization,
+        embedding_service=args.embedding_service,
     )
     ingester.main()
 
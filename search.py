@@ -0,0 +1,298 @@
+import bisect
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+
+def serialize_f32(vector: List[float]) -> bytes:
+    """serializes a list of floats into a compact "raw bytes" format"""
+    return struct.pack("%sf" % len(vector), *vector)
+
+
+class SearchResult(NamedTuple):
+    chunk_id: int
+    distance: float  # Euclidean distance, as reported by sqlite-vec
+    char_offset: int
+    length: int
+
+
+def fetch_chunk_embedding(db, chunk_id: int) -> np.ndarray | None:
+    """Read the stored embedding of a chunk. The ingester writes embeddings with rowid == chunk_id."""
+    row = db.execute("SELECT embedding FROM embeddings WHERE rowid = ?", [chunk_id]).fetchone()
+    if row is None:
+        return None
+    return np.frombuffer(row[0], dtype=np.float32)
+
+
+class ChunkSpanIndex:
+    """Maps a character span of a document to the ingested chunk (sentence) it lines up with.
+
+    Chunk boundaries come from `chunks.char_offset` and the chunk text lengths. They are loaded
+    lazily per (sample_id, text_type) and kept in a bounded LRU.
+    """
+
+    def __init__(self, database, tolerance: int = 2, max_documents: int = 4096):
+        self.database = database
+        self.tolerance = tolerance
+        self.max_documents = max_documents
+        self.documents: OrderedDict[Tuple[int, str], Tuple[List[int], List[int], List[int]]] = OrderedDict()
+        self.lock = threading.Lock() # `match` runs in FastAPI's thread pool
+        self.lookups = 0
+        self.matches = 0
+
+    def get_spans(self, sample_id: int, text_type: str) -> Tuple[List[int], List[int], List[int]]:
+        key = (sample_id, text_type)
+        with self.lock:
+            spans = self.documents.get(key)
+            if spans is not None:
+                self.documents.move_to_end(key)
+                return spans
+        rows = self.database.read_db.execute(
+            "SELECT chunk_id, char_offset, length(text) FROM chunks WHERE sample_id = ? AND text_type = ? ORDER BY char_offset",
+            [sample_id, text_type],
+        ).fetchall()
+        chunk_ids = [row[0] for row in rows]
+        starts = [row[1] for row in rows]
+        ends = [row[1] + row[2] for row in rows]
+        spans = (starts, ends, chunk_ids)
+        with self.lock:
+            self.documents[key] = spans
+            if len(self.documents) > self.max_documents:
+                self.documents.popitem(last=False)
+        return spans
+
+    def match(self, sample_id: int, text_type: str, start: int, end: int) -> int | None:
+        """Return the chunk_id of the chunk that the span [start, end) covers within the tolerance, if any."""
+        if self.tolerance < 0:
+            return None
+        self.lookups += 1
+        starts, ends, chunk_ids = self.get_spans(sample_id, text_type)
+        i = bisect.bisect_right(starts, start + self.tolerance) - 1
+        best, best_error = None, None
+        for j in (i, i - 1):  # with a large tolerance the previous chunk may be the better fit
+            if j < 0:
+                continue
+            error = max(abs(start - starts[j]), abs(end - ends[j]))
+            if error <= self.tolerance and (best_error is None or error < best_error):
+                best, best_error = chunk_ids[j], error
+        if best is not None:
+            self.matches += 1
+        return best
+
+    def stats(self) -> dict:
+        return {
+            "documents": len(self.documents),
+            "lookups": self.lookups,
+            "matches": self.matches,
+        }
+
+
+class SqliteVecSearch:
+    """Selection search with a sqlite-vec KNN query restricted to the chunks of the opposite document.
+
+    If the database was ingested with `--quantization`, the KNN query runs on the compact
+    `embeddings_quantized` table for `rescore_factor * top_k` candidates, which are then
+    rescored with their full-precision vectors.
+    """
+
+    def __init__(self, database, quantization: str = "none", rescore_factor: int = 4):
+        self.database = database
+        self.quantization = quantization
+        self.rescore_factor = rescore_factor
+
+    def search(self, sample_id: int, text_type: str, embedding: np.ndarray, top_k: int = 5) -> List[SearchResult]:
+        db = self.database.read_db
+        rows = db.execute(
+            "SELECT chunk_id, char_offset, length(text) FROM chunks WHERE text_type = ? AND sample_id = ?",
+            [text_type, sample_id],
+        ).fetchall()
+        if len(rows) == 0:
+            return []
+        if len(rows) == 1:  # no need for vector search
+            return [SearchResult(rows[0][0], 0.0, rows[0][1], rows[0][2])]
+        chunks = {row[0]: row for row in rows}
+
+        if self.quantization != "none":
+            return self.search_quantized(chunks, embedding, top_k)
+
+        # rowid in `embeddings` is the chunk_id, see Ingester.ingest
+        sql_cmd = "SELECT rowid, distance FROM embeddings WHERE rowid IN ({0}) AND embedding MATCH ? ORDER BY distance LIMIT {1}".format(
+            ", ".join(str(int(chunk_id)) for chunk_id in chunks), int(top_k)
+        )
+        vector_search_result = db.execute(sql_cmd, [serialize_f32(embedding)]).fetchall()
+        return [
+            SearchResult(rowid, distance, chunks[rowid][1], chunks[rowid][2])
+            for rowid, distance in vector_search_result
+        ]
+
+
+    def search_quantized(self, chunks: dict, embedding: np.ndarray, top_k: int) -> List[SearchResult]:
+        db = self.database.read_db
+        quantize = "vec_quantize_int8(?, 'unit')" if self.quantization == "int8" else "vec_quantize_binary(?)"
+        sql_cmd = "SELECT rowid FROM embeddings_quantized WHERE rowid IN ({0}) AND embedding MATCH {1} ORDER BY distance LIMIT {2}".format(
+            ", ".join(str(int(chunk_id)) for chunk_id in chunks), quantize, int(top_k * self.rescore_factor)
+        )
+        candidates = [row[0] for row in db.execute(sql_cmd, [serialize_f32(embedding)]).fetchall()]
+        if len(candidates) == 0:
+            return []
+
+        sql_cmd = "SELECT rowid, embedding FROM embeddings WHERE rowid IN ({0})".format(", ".join("?" for _ in candidates))
+        rows = db.execute(sql_cmd, candidates).fetchall()
+        vectors = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+        distances = np.linalg.norm(vectors - np.asarray(embedding, dtype=np.float32), axis=1)
+        top = np.argsort(distances)[:top_k]
+        return [
+            SearchResult(rows[i][0], float(distances[i]), chunks[rows[i][0]][1], chunks[rows[i][0]][2])
+            for i in top
+        ]
+
+
+class SampleMatrix(NamedTuple):
+    chunk_ids: np.ndarray
+    char_offsets: np.ndarray
+    lengths: np.ndarray
+    embeddings: np.ndarray  # (num_chunks, embedding_dimension), contiguous float32
+    squared_norms: np.ndarray
+
+
+def load_sample_matrices(db, sample_id: int) -> dict[str, SampleMatrix]:
+    """Load the chunk embeddings of one sample as one matrix per text_type, ordered by chunk_offset."""
+    rows = db.execute(
+        "SELECT c.chunk_id, c.text_type, c.char_offset, length(c.text), e.embedding \
+         FROM chunks c JOIN embeddings e ON e.rowid = c.chunk_id \
+         WHERE c.sample_id = ? ORDER BY c.text_type, c.chunk_offset",
+        [sample_id],
+    ).fetchall()
+    grouped: dict[str, list] = {}
+    for row in rows:
+        grouped.setdefault(row[1], []).append(row)
+    matrices = {}
+    for text_type, group in grouped.items():
+        embeddings = np.ascontiguousarray(
+            np.stack([np.frombuffer(row[4], dtype=np.float32) for row in group])
+        )
+        matrices[text_type] = SampleMatrix(
+            chunk_ids=np.array([row[0] for row in group], dtype=np.int64),
+            char_offsets=np.array([row[2] for row in group], dtype=np.int64),
+            lengths=np.array([row[3] for row in group], dtype=np.int64),
+            embeddings=embeddings,
+            squared_norms=np.einsum("ij,ij->i", embeddings, embeddings),
+        )
+    return matrices
+
+
+class NumpySearch:
+    """Selection search over in-memory per-sample embedding matrices.
+
+    Each sample's chunk embeddings are loaded once into contiguous float32 matrices and kept in an
+    LRU keyed by sample_id. A search is one matrix-vector product plus `argpartition`. Distances are
+    Euclidean so that scores are the same as the sqlite-vec backend.
+    """
+
+    def __init__(self, database, max_samples: int = 1024):
+        self.database = database
+        self.max_samples = max_samples
+        self.samples: OrderedDict[int, dict[str, SampleMatrix]] = OrderedDict()
+        self.loading: dict[int, Future] = {} # samples being loaded, so concurrent searches wait instead of loading them again
+        self.lock = threading.Lock() # `search` runs in FastAPI's thread pool
+
+    def get_sample(self, sample_id: int) -> dict[str, SampleMatrix]:
+        with self.lock:
+            matrices = self.samples.get(sample_id)
+            if matrices is not None:
+                self.samples.move_to_end(sample_id)
+                return matrices
+            future = self.loading.get(sample_id)
+            loader = future is None
+            if loader:
+                future = self.loading[sample_id] = Future()
+        if not loader:
+            return future.result()
+        try:
+            matrices = load_sample_matrices(self.database.read_db, sample_id)
+        except Exception as e:
+            with self.lock:
+                del self.loading[sample_id]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.loading[sample_id]
+            self.samples[sample_id] = matrices
+            if len(self.samples) > self.max_samples:
+                self.samples.popitem(last=False)
+        future.set_result(matrices)
+        return matrices
+
+    def search(self, sample_id: int, text_type: str, embedding: np.ndarray, top_k: int = 5) -> List[SearchResult]:
+        matrix = self.get_sample(sample_id).get(text_type)
+        if matrix is None:
+            return []
+        if len(matrix.chunk_ids) == 1:  # no need for vector search
+            return [SearchResult(int(matrix.chunk_ids[0]), 0.0, int(matrix.char_offsets[0]), int(matrix.lengths[0]))]
+        query = np.asarray(embedding, dtype=np.float32)
+        squared_distances = matrix.squared_norms - 2 * (matrix.embeddings @ query) + query @ query
+        k = min(top_k, len(squared_distances))
+        top = np.argpartition(squared_distances, k - 1)[:k]
+        top = top[np.argsort(squared_distances[top])]
+        distances = np.sqrt(np.maximum(squared_distances[top], 0))
+        return [
+            SearchResult(int(matrix.chunk_ids[i]), float(distance), int(matrix.char_offsets[i]), int(matrix.lengths[i]))
+            for i, distance in zip(top, distances)
+        ]
+
+
+def align_samples(matrices: dict[str, SampleMatrix], top_k: int) -> List[Tuple[int, int, float]]:
+    """Compute the top-k cross-document neighbours of every chunk in a sample.
+
+    Returns (chunk_id, neighbor_chunk_id, score) rows for both directions, where the score is
+    1 - Euclidean distance, the same score `/task/{task_index}/select` serves.
+    """
+    rows = []
+    for from_type, to_type in (("source", "summary"), ("summary", "source")):
+        a, b = matrices.get(from_type), matrices.get(to_type)
+        if a is None or b is None:
+            continue
+        if len(b.chunk_ids) == 1:  # same as the single-chunk shortcut of the search backends
+            distances = np.zeros((len(a.chunk_ids), 1), dtype=np.float32)
+        else:
+            squared_distances = a.squared_norms[:, None] + b.squared_norms[None, :] - 2 * (a.embeddings @ b.embeddings.T)
+            distances = np.sqrt(np.maximum(squared_distances, 0))
+        k = min(top_k, distances.shape[1])
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        for i, neighbors in enumerate(top):
+            for j in neighbors:
+                rows.append((int(a.chunk_ids[i]), int(b.chunk_ids[j]), float(1 - distances[i, j])))
+    return rows
+
+
+class AlignmentIndex:
+    """Answers whole-chunk selections from the `chunk_alignments` table precomputed by `Ingester.align`."""
+
+    def __init__(self, database, top_k: int):
+        self.database = database
+        self.top_k = top_k
+        self.lookups = 0
+
+    def lookup(self, chunk_id: int, top_k: int = 5) -> List[SearchResult] | None:
+        if top_k > self.top_k:  # the table does not hold enough neighbours, fall back to search
+            return None
+        rows = self.database.read_db.execute(
+            "SELECT a.neighbor_chunk_id, a.score, c.char_offset, length(c.text) \
+             FROM chunk_alignments a JOIN chunks c ON c.chunk_id = a.neighbor_chunk_id \
+             WHERE a.chunk_id = ? ORDER BY a.score DESC LIMIT ?",
+            [chunk_id, top_k],
+        ).fetchall()
+        if len(rows) == 0:
+            return None
+        self.lookups += 1
+        return [SearchResult(row[0], 1 - row[1], row[2], row[3]) for row in rows]
+
+
+SEARCH_BACKENDS = {
+    "sqlite-vec": SqliteVecSearch,
+    "numpy": NumpySearch,
+}
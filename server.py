@@ -1,13 +1,15 @@
+import argparse
+import asyncio
 import json
 import os
 import sys
 import uuid
+from contextlib import asynccontextmanager
 from typing import Annotated
-import struct
 
 import uvicorn
 from dotenv import load_dotenv
-from fastapi import FastAPI, Header
+from fastapi import APIRouter, FastAPI, Header
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from typing import List
@@ -15,30 +17,25 @@ from typing import List
 load_dotenv()
 
 # from better_vectara import BetterVectara as Vectara
-from database import Database, LabelData
+from database import Database, LabelData, TaskStore, encode_json, encode_jsonl
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import FileResponse
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
 
 import yaml
 import sqlite3
 import sqlite_vec
-from ingester import Embedder
 from database import Database
+# the ingest tooling (spaCy, pandas) stays out of the server. The embedding model is loaded in the background.
+from embedding import BackgroundEmbedder, EmbeddingCache, EmbeddingDispatcher, QueryEmbeddingCache
+from embedding_service import RemoteEmbedder
+from search import SEARCH_BACKENDS, AlignmentIndex, ChunkSpanIndex, fetch_chunk_embedding
 
-app = FastAPI()
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# The routes live on a router. `create_app` builds the app around it, see the bottom of this file.
+router = APIRouter()
 # vectara_client = Vectara()
 
-def serialize_f32(vector: List[float]) -> bytes:
-    """serializes a list of floats into a compact "raw bytes" format"""
-    return struct.pack("%sf" % len(vector), *vector)
-
 class Label(BaseModel):
     summary_start: int
     summary_end: int
@@ -55,28 +52,28 @@ class Selection(BaseModel):
 class Name(BaseModel):
     name: str
 
-@app.get("/candidate_labels") 
+@router.get("/candidate_labels") 
 async def get_labels() -> list: # get all candidate labels for human annotators to choose from
     with open("labels.yaml") as f:
         labels = yaml.safe_load(f)
     return labels
 
-@app.get("/user/new") # please update the route name to be more meaningful, e.g., /user/new_user
-async def create_new_user():
+@router.get("/user/new") # please update the route name to be more meaningful, e.g., /user/new_user
+def create_new_user():
     user_id = uuid.uuid4().hex
     user_name = "New User"
     database.add_user(user_id, user_name)
     return {"key": user_id, "name": user_name}
 
-@app.post("/user/name")
-async def update_user_name(name: Name, user_key: Annotated[str, Header()]):
+@router.post("/user/name")
+def update_user_name(name: Name, user_key: Annotated[str, Header()]):
     if user_key.startswith('"') and user_key.endswith('"'):
         user_key = user_key[1:-1]
     database.change_user_name(user_key, name.name)
     return {"message": "success"}
 
-@app.get("/user/me")
-async def get_user_name(user_key: Annotated[str, Header()]):
+@router.get("/user/me")
+def get_user_name(user_key: Annotated[str, Header()]):
     if user_key.startswith('"') and user_key.endswith('"'):
         user_key = user_key[1:-1]
     username = database.get_user_name(user_key)
@@ -85,41 +82,59 @@ async def get_user_name(user_key: Annotated[str, Header()]):
     else:
         return {"name": username}
 
-@app.get("/user/export") # please update the route name to be more meaningful, e.g., /user/export_user_data
-async def export_user_data(user_key: Annotated[str, Header()]):
+@router.get("/user/export") # please update the route name to be more meaningful, e.g., /user/export_user_data
+def export_user_data(user_key: Annotated[str, Header()]):
     if user_key.startswith('"') and user_key.endswith('"'):
         user_key = user_key[1:-1]
-    return database.dump_annotator_labels(user_key)
+    return StreamingResponse(encode_json(database.iter_export(annotator=user_key)), media_type="application/json")
+
+
+async def embed_query(query: str):
+    """Embed a selection query, consulting the query embedding cache before running the model."""
+    key = (configs["embedding_model_id"], configs["embedding_dimension"], query)
+    embedding = query_cache.get_memory(key)
+    if embedding is not None:
+        return embedding
+    if query_cache.store is not None:
+        # the persistent cache is SQLite. Keep it off the event loop.
+        embedding = await run_in_threadpool(query_cache.get_stored, key)
+    else:
+        embedding = query_cache.get_stored(key)
+    if embedding is None:
+        embedding = await dispatcher.embed(query)
+        # with a store, this only queues the write on the annotation writer, see `init_state`
+        query_cache.put(key, embedding)
+    return embedding
 
 
-@app.get("/task")
-async def get_tasks_length():
-    return {"all": len(tasks)}
+@router.get("/task")
+def get_tasks_length(): # counts the documents in SQLite, so FastAPI runs it in its thread pool
+    return {"all": len(task_store)}
 
 
-@app.get("/task/{task_index}")
-async def get_task(task_index: int = 0):
-    if task_index >= len(tasks):
+@router.get("/task/{task_index}")
+def get_task(task_index: int = 0):
+    task = task_store.get(task_index)
+    if task is None:
         return {"error": "Invalid task index"}
-    task = tasks[task_index]
     return {"doc": task["source"], "sum": task["summary"]}
 
 
-@app.get("/task/{task_index}/history")
-async def get_task_history(task_index: int, user_key: Annotated[str, Header()]):
+@router.get("/task/{task_index}/history")
+def get_task_history(task_index: int, user_key: Annotated[str, Header()]):
     if user_key.startswith('"') and user_key.endswith('"'):
         user_key = user_key[1:-1]
     return database.export_task_history(task_index, user_key)
 
 
-@app.post("/task/{task_index}/label")
+@router.post("/task/{task_index}/label")
 async def post_task(task_index: int, label: Label, user_key: Annotated[str, Header()]):
     if user_key.startswith('"') and user_key.endswith('"'):
         user_key = user_key[1:-1]
 
     # label_data = LabelData(
     #     record_id="not assigned",
-    #     sample_id=tasks[task_index]["_id"],
+    #     sample_id=task_store.get(task_index)["_id"],
     #     summary_start=label.summary_start,
     #     summary_end=label.summary_end,
     #     source_start=label.source_start,
@@ -140,29 +155,42 @@ async def post_task(task_index: int, label: Label, user_key: Annotated[str, Head
     
     label_string = json.dumps(label.consistent)
     
-    database.push_annotation({
+    # the writer thread commits it together with other concurrent writes. Wait until it is durable.
+    await asyncio.wrap_future(database.push_annotation({
         "sample_id": sample_id,
         "annotator": annotator,
         "label": label_string,
         "annot_spans": annot_spans,
         "note": label.note
-    }) # the label_data is in databse.OldLabelData format
+    })) # the label_data is in databse.OldLabelData format
     return {"message": "success"}
 
 
-@app.post("/task/{task_index}/select") # TODO: to be updated by Forrest using openAI's API or local model to embed text on the fly
+def lookup_ingested_chunk(task_index: int, from_text_type: str, selection: Selection):
+    """If the selection lines up with an ingested chunk, return its precomputed neighbours, or else its stored embedding."""
+    chunk_id = span_index.match(task_index, from_text_type, selection.start, selection.end)
+    if chunk_id is None:
+        return None, None
+    if alignment_index is not None:
+        search_results = alignment_index.lookup(chunk_id, top_k=5)
+        if search_results is not None:
+            return search_results, None
+    return None, fetch_chunk_embedding(database.read_db, chunk_id)
+
+
+@router.post("/task/{task_index}/select") # TODO: to be updated by Forrest using openAI's API or local model to embed text on the fly
 async def post_selections(task_index: int, selection: Selection):
-    if task_index >= len(tasks):
-        return {"error": "Invalid task index"}
-    if task_index < 0:
+    # the SQLite reads below run in the thread pool. Only `embed_query` waits on the event loop.
+    task = await run_in_threadpool(task_store.get, task_index)
+    if task is None:
         return {"error": "Invalid task index"}
     # use_id = source_corpus_id if selection.from_summary else summary_corpus_id
     query = (
-        tasks[task_index]["source"][selection.start : selection.end]
+        task["source"][selection.start : selection.end]
         if not selection.from_summary
-        else tasks[task_index]["summary"][selection.start : selection.end]
+        else task["summary"][selection.start : selection.end]
     )
-    id_ = tasks[task_index]["_id"]
+    id_ = task["_id"]
 
     # response = vectara_client.query(
     #     corpus_id=use_id,
@@ -174,68 +202,31 @@ async def post_selections(task_index: int, selection: Selection):
     #     do_generation=False,
     # )
 
-    # first embedd query 
-    embedding = embedder.embed([query], embedding_dimension=configs["embedding_dimension"])[0]
-    
-    # Then get the chunk_id's from the opposite document
-    sql_cmd = "SELECT chunk_id, text FROM chunks WHERE text_type = ? AND sample_id = ?"
     if selection.from_summary:
-        text_type = "source"
+        from_text_type, text_type = "summary", "source"
     else:
-        text_type = "summary"
-
-    chunk_id_and_text = database.db.execute(sql_cmd, [text_type, task_index]).fetchall()
-    search_chunk_ids = [row[0] for row in chunk_id_and_text]
-    vecter_db_row_ids = [str(x+1) for x in search_chunk_ids] # rowid starts from 1 while chunk_id starts from 0
-
-    if len(search_chunk_ids) == 1: # no need for vector search
-        selections = [{
-            "score": 1.0,
-            "offset": 0,
-            "len": len(chunk_id_and_text[0][1]),
-            "to_doc": selection.from_summary,
-        }]
-        return selections
-
-    # Do vector search on the `embeddings` table when rowid is in chunk_ids
-    # print ("Search for row ids: ", search_chunk_ids)
-    # print ("Embedding: ", embedding)    
-    sql_cmd = " \
-        SELECT  \
-            rowid, \
-            distance \
-        FROM embeddings "  \
-        " WHERE rowid IN ({0})" \
-        "AND embedding MATCH '{1}'  \
-        ORDER BY distance \
-        LIMIT 5;".format(', '.join(vecter_db_row_ids), embedding)
-    # print ("SQL_CMD", sql_cmd)
-    
-    # vector_search_result = database.db.execute(sql_cmd, [*search_chunk_ids, serialize_f32(embedding)]).fetchall()
-    vector_search_result = database.db.execute(sql_cmd).fetchall()
-    # [(2, 0.20000001788139343), (1, 0.40000003576278687)]
-    # turn this into a dict from chunk__id to distance/score
-    chunk_id_to_score = {row[0]: row[1] for row in vector_search_result}
-    chunk_ids_of_top_k = [row[0] for row in vector_search_result]
-
-    # get the char_offset and len from the chunks table based on the chunk_ids
-    sql_cmd = "SELECT chunk_id, text, char_offset FROM chunks WHERE chunk_id in ({0});".format(', '.join('?' for _ in chunk_ids_of_top_k))
-    search_chunk_ids = [row[0] for row in vector_search_result]
-    response = database.db.execute(sql_cmd, search_chunk_ids).fetchall()
-    # [(1, 'This is a test.', 0, 14), (2, 'This is a test.', 15, 14)]
+        from_text_type, text_type = "source", "summary"
+
+    search_results, embedding = await run_in_threadpool(lookup_ingested_chunk, task_index, from_text_type, selection)
+
+    if search_results is None:
+        # first embedd query, unless the selection lines up with an ingested chunk whose embedding is stored.
+        # The dispatcher runs the model in a worker thread and batches concurrent selections.
+        if embedding is None:
+            embedding = await embed_query(query)
+
+        # Then search the chunks of the opposite document
+        search_results = await run_in_threadpool(search_backend.search, task_index, text_type, embedding, top_k=5)
 
     # organize into a dict of keys "score", "offset", "len", "to_doc"
     # and append to a list of selections
     selections = []
-    for i in response:
-        score = chunk_id_to_score[i[0]]
-        offset = i[2]
-        text = i[1]
+    for result in search_results:
         selections.append(
             {
-                "score": 1 - score, # semantic similarity is 1 - distance
-                "offset": offset,
-                "len": len(text),
+                "score": 1 - result.distance, # semantic similarity is 1 - distance
+                "offset": result.char_offset,
+                "len": result.length,
                 "to_doc": selection.from_summary,
             }
         )
@@ -262,43 +253,201 @@ async def post_selections(task_index: int, selection: Selection):
     return selections
 
 
-@app.delete("/record/{record_id}")
+@router.delete("/record/{record_id}")
 async def delete_annotation(record_id: str, user_key: Annotated[str, Header()]):
     if user_key.startswith('"') and user_key.endswith('"'):
         user_key = user_key[1:-1]
-    database.delete_annotation(record_id, user_key)
+    await asyncio.wrap_future(database.delete_annotation(record_id, user_key))
     return {"message": f"delete anntation {record_id} success"}
 
-@app.get("/labels")
-async def get_labels():
-    return database.dump_annotation(dump_file=None)
-
-@app.get("/history")  # redirect route to history.html
+@router.get("/labels")
+def get_labels(
+    after: int | None = None,
+    limit: int | None = None,
+    sample_id_min: int | None = None,
+    sample_id_max: int | None = None,
+    annotator: str | None = None,
+    label: str | None = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+):
+    """Samples with their annotations, in sample_id order.
+
+    With `limit`, one page is returned and the `X-Next-Cursor` header holds the `after` value of the
+    next page. It is absent once a page comes back short. Without it, everything is streamed in one response.
+    """
+    # the ETag only depends on a change counter, so unchanged data is answered without reading it
+    etag = database.labels_etag()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+
+    if after is not None:
+        sample_id_min = after + 1 if sample_id_min is None else max(sample_id_min, after + 1)
+    records = database.iter_export(
+        annotator=annotator, label=label, sample_id_min=sample_id_min, sample_id_max=sample_id_max, limit=limit
+    )
+    if limit is None:
+        # streamed sample by sample, so memory stays flat however many annotations there are
+        return StreamingResponse(encode_json(records), media_type="application/json", headers=headers)
+    page = list(records)
+    if len(page) == limit and limit > 0:
+        headers["X-Next-Cursor"] = str(page[-1]["sample_id"])
+    return JSONResponse(page, headers=headers)
+
+@router.get("/labels/changes")
+def get_label_changes(since: int = 0, limit: int | None = None):
+    """Annotation inserts and deletes after sequence number `since`, one JSON object per line."""
+    return StreamingResponse(encode_jsonl(database.iter_changes(since, limit)), media_type="application/x-ndjson")
+
+# plain functions, so FastAPI runs them in its thread pool: with --embedding_service, `embedder.stats()` is an HTTP request
+@router.get("/ready")
+def get_ready():
+    """200 once the embedding model is loaded, 503 before. Other endpoints do not wait for it."""
+    stats = embedder.stats()
+    return JSONResponse(stats, status_code=200 if stats["ready"] else 503)
+
+@router.get("/stats")
+def get_stats():
+    return {
+        "embedder": embedder.stats(),
+        "tasks": task_store.stats(),
+        "query_cache": query_cache.stats(),
+        "span_index": span_index.stats(),
+        "annotation_writer": database.writer.stats(),
+    }
+
+@router.get("/history")  # redirect route to history.html
 async def history():
     return FileResponse("dist/history.html")
 
-@app.get("/viewer")
+@router.get("/viewer")
 async def viewer():
     return FileResponse("dist/viewer.html")
 
-if __name__ == "__main__":
-
-    app.mount("/", StaticFiles(directory="dist", html=True), name="dist")
-
-    import argparse
-
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("--sqlite_db", type=str, default="./mercury.sqlite")
     parser.add_argument("--port", type=int, default=8000)
-    args = parser.parse_args()
-
-    print ("Using sqlite db: ", args.sqlite_db)
+    parser.add_argument("--workers", type=int, default=1, help="Number of server processes. Each one opens its own connections and loads its own copy of the embedding model")
+    parser.add_argument("--embedding_service", type=str, default="", help="Embed through a shared embedding service (embedding_service.py) at unix:/path/to/socket or http://host:port instead of loading the model in every worker")
+    parser.add_argument("--embed_batch_window_ms", type=float, default=5, help="How long to wait for more selection queries before embedding them in one batch")
+    parser.add_argument("--embed_max_batch_size", type=int, default=32, help="Embed a batch right away once this many queries are pending")
+    parser.add_argument("--embed_workers", type=int, default=1, help="Number of worker threads running the embedder")
+    parser.add_argument("--span_match_tolerance", type=int, default=2, help="Reuse the stored embedding of a chunk when a selection matches its boundaries within this many characters. -1 disables it")
+    parser.add_argument("--search_backend", type=str, default="sqlite-vec", choices=list(SEARCH_BACKENDS), help="'sqlite-vec' runs a vec0 KNN query per selection. 'numpy' keeps per-sample embedding matrices in memory")
+    parser.add_argument("--numpy_cache_samples", type=int, default=1024, help="How many samples the numpy search backend keeps in memory")
+    parser.add_argument("--rescore_factor", type=int, default=4, help="With quantized embeddings, rescore this many times the number of returned highlights with full-precision vectors")
+    parser.add_argument("--task_cache_size", type=int, default=1024, help="How many reconstructed source-summary pairs to keep in memory")
+    parser.add_argument("--query_cache_mb", type=float, default=64, help="Memory cap of the query embedding cache in MB")
+    parser.add_argument("--write_batch_size", type=int, default=64, help="Commit at most this many annotation writes in one transaction")
+    parser.add_argument("--write_delay_ms", type=float, default=5, help="How long the annotation writer waits for more writes before committing")
+    parser.add_argument("--persist_query_cache", action="store_true", default=False, help="Look up and persist query embeddings in the `embedding_cache` table of the SQLite db so restarts do not start cold")
+    return parser
+
+
+def load_settings(**options) -> argparse.Namespace:
+    """The server options: the CLI defaults, overridden by MERCURY_<OPTION> environment variables, then by `options`.
+
+    Worker processes started by `uvicorn --factory` or gunicorn cannot receive arguments, so they read the environment.
+    """
+    settings = build_parser().parse_args([])
+    for name, default in vars(settings).items():
+        value = os.environ.get(f"MERCURY_{name.upper()}")
+        if value is None:
+            continue
+        if isinstance(default, bool):
+            setattr(settings, name, value.lower() in ("1", "true", "yes"))
+        else:
+            setattr(settings, name, type(default)(value))
+    for name, value in options.items():
+        if not hasattr(settings, name):
+            raise TypeError(f"Unknown server option {name}")
+        setattr(settings, name, value)
+    return settings
+
+
+def init_state(settings: argparse.Namespace):
+    """Open the database and set up the serving components of this process."""
+    global database, task_store, configs, embedder, dispatcher, query_cache, span_index, search_backend, alignment_index
+
+    print ("Using sqlite db: ", settings.sqlite_db)
+
+    database = Database(settings.sqlite_db, write_batch_size=settings.write_batch_size, write_delay=settings.write_delay_ms / 1000)
+
+    # tasks are the source-summary pairs to label, loaded from the chunks when first requested
+    task_store = TaskStore(database, max_tasks=settings.task_cache_size)
+    configs = database.fetch_configs()
+    if settings.embedding_service:
+        embedder = RemoteEmbedder(settings.embedding_service)
+        if embedder.name != configs["embedding_model_id"]:
+            raise Exception(f"The embedding service serves {embedder.name}, but {settings.sqlite_db} was ingested with {configs['embedding_model_id']}")
+    else:
+        # only selections that need a new embedding wait for the model. Everything else is served right away.
+        embedder = BackgroundEmbedder(configs["embedding_model_id"])
+    dispatcher = EmbeddingDispatcher(
+        embedder,
+        embedding_dimension=configs["embedding_dimension"],
+        batch_window=settings.embed_batch_window_ms / 1000,
+        max_batch_size=settings.embed_max_batch_size,
+        num_workers=settings.embed_workers,
+    )
+    query_cache = QueryEmbeddingCache(
+        max_bytes=int(settings.query_cache_mb * 1024 * 1024),
+        # writes go through the annotation writer, the server's single writer of the database
+        store=EmbeddingCache(settings.sqlite_db, writer=database.writer) if settings.persist_query_cache else None,
+    )
+    span_index = ChunkSpanIndex(database, tolerance=settings.span_match_tolerance)
+    if settings.search_backend == "numpy":
+        search_backend = SEARCH_BACKENDS["numpy"](database, max_samples=settings.numpy_cache_samples)
+    else:
+        search_backend = SEARCH_BACKENDS["sqlite-vec"](
+            database, quantization=configs.get("quantization", "none"), rescore_factor=settings.rescore_factor
+        )
+    alignment_index = AlignmentIndex(database, top_k=int(configs["align_top_k"])) if int(configs.get("align_top_k", 0)) > 0 else None
+
+
+def create_app(sqlite_db: str | None = None, **options) -> FastAPI:
+    """Build the Mercury app. Options are the CLI options of server.py, see `load_settings`.
+
+    The state is set up when the app starts, in each worker process, not when the app is created.
+    So threads and SQLite connections are never shared across a fork. Run several workers with
+    `uvicorn server:create_app --factory --workers N`, or `python3 server.py --workers N`.
+    """
+    if sqlite_db is not None:
+        options["sqlite_db"] = sqlite_db
+    settings = load_settings(**options)
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        init_state(settings)
+        yield
+        dispatcher.shutdown()
+        if query_cache.store is not None:
+            query_cache.store.close() # writes the pending hit/miss counters
+
+    app = FastAPI(lifespan=lifespan)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["ETag", "X-Next-Cursor"],
+    )
+    app.add_middleware(GZipMiddleware, minimum_size=1024)
+    app.include_router(router)
+    if os.path.isdir("dist"):
+        app.mount("/", StaticFiles(directory="dist", html=True), name="dist")
+    return app
 
-    database = Database(args.sqlite_db)
 
-    # TODO: the name 'tasks' can be misleading. It should be changed to something more descriptive.
-    tasks = database.fetch_data_for_labeling()
-    configs = database.fetch_configs()
-    embedder = Embedder(configs["embedding_model_id"])
+if __name__ == "__main__":
+    args = build_parser().parse_args()
 
-    uvicorn.run(app, port=args.port, host="0.0.0.0")
+    if args.workers > 1:
+        # the worker processes build their own app and read the options from the environment
+        for name, value in vars(args).items():
+            os.environ[f"MERCURY_{name.upper()}"] = str(value)
+        uvicorn.run("server:create_app", factory=True, workers=args.workers, port=args.port, host="0.0.0.0")
+    else:
+        uvicorn.run(create_app(**vars(args)), port=args.port, host="0.0.0.0")
@@ -0,0 +1,98 @@
+import json
+import sqlite3
+
+import pytest
+
+pytest.importorskip("sqlite_vec")
+spacy = pytest.importorskip("spacy")
+np = pytest.importorskip("numpy")
+try:
+    spacy.load("en_core_web_sm")
+except OSError:
+    pytest.skip("the en_core_web_sm spaCy model is not installed", allow_module_level=True)
+
+import ingester
+
+
+class FakeEmbedder:
+    """Deterministic embeddings, so the test needs neither a model download nor an API key."""
+
+    def __init__(self, name, **kwargs):
+        self.name = name
+
+    def embed(self, texts, embedding_dimension=512, batch_size=12):
+        rng = np.random.default_rng(len(texts))
+        embeddings = rng.standard_normal((len(texts), embedding_dimension)).astype(np.float32)
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+SAMPLES = [
+    {"source": "The quick brown fox. Jumps over a lazy dog.", "summary": "A fox jumps.", "model": "a"},
+    {"source": "We the people. Of the U.S.A.", "summary": "The U.S. Constitution. It is great.", "model": "b"},
+]
+
+
+@pytest.mark.parametrize("pipeline", [False, True])
+def test_default_ingest_on_fresh_database(tmp_path, monkeypatch, pipeline):
+    monkeypatch.setattr(ingester, "Embedder", FakeEmbedder)
+    file_to_ingest = tmp_path / "data.jsonl"
+    file_to_ingest.write_text("\n".join(json.dumps(sample) for sample in SAMPLES))
+    sqlite_db_path = str(tmp_path / "mercury.sqlite")
+
+    # default settings, with the embedding cache in a sidecar file
+    ingester.Ingester(
+        file_to_ingest=str(file_to_ingest),
+        embedding_dimension=8,
+        embedding_model_id="dummy",
+        sqlite_db_path=sqlite_db_path,
+        align_top_k=1,
+        pipeline=pipeline,
+    ).main()
+
+    db = sqlite3.connect(sqlite_db_path)
+    assert db.execute("SELECT COUNT(DISTINCT sample_id) FROM chunks").fetchone()[0] == len(SAMPLES)
+    assert db.execute("SELECT COUNT(*) FROM documents").fetchone()[0] == 2 * len(SAMPLES)
+    assert db.execute("SELECT name FROM sqlite_master WHERE name = 'embedding_cache'").fetchone() is None
+    cache = sqlite3.connect(str(tmp_path / "mercury.embcache.sqlite"))
+    assert cache.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0] > 0
+    assert db.execute("SELECT COUNT(*) FROM chunk_alignments").fetchone()[0] > 0
+    assert db.execute("SELECT text FROM documents WHERE sample_id = 1 AND text_type = 'summary'").fetchone()[0] == SAMPLES[1]["summary"]
+
+
+def ingest(tmp_path, name, samples, **options):
+    file_to_ingest = tmp_path / name
+    file_to_ingest.write_text("\n".join(json.dumps(sample) for sample in samples))
+    ingester.Ingester(
+        file_to_ingest=str(file_to_ingest),
+        embedding_dimension=8,
+        embedding_model_id="dummy",
+        sqlite_db_path=str(tmp_path / "mercury.sqlite"),
+        **options,
+    ).main()
+    return sqlite3.connect(str(tmp_path / "mercury.sqlite"))
+
+
+@pytest.mark.parametrize("read_batch_size", [1, 1000])
+def test_duplicates_are_skipped(tmp_path, monkeypatch, read_batch_size):
+    monkeypatch.setattr(ingester, "Embedder", FakeEmbedder)
+    same_documents_other_model = {**SAMPLES[1], "model": "c"}
+    db = ingest(tmp_path, "data.jsonl", SAMPLES + [SAMPLES[0], same_documents_other_model], read_batch_size=read_batch_size)
+    # the repeated record is skipped wherever it falls, the one with other metadata is not
+    assert db.execute("SELECT sample_id, json_meta FROM sample_meta ORDER BY sample_id").fetchall() == [
+        (0, '{"model": "a"}'), (1, '{"model": "b"}'), (2, '{"model": "c"}')
+    ]
+
+    db = ingest(tmp_path, "again.jsonl", list(reversed(SAMPLES)))
+    assert db.execute("SELECT COUNT(*) FROM documents").fetchone()[0] == 2 * 3
+
+
+def test_appending_to_a_database_without_sample_hashes(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingester, "Embedder", FakeEmbedder)
+    db = ingest(tmp_path, "data.jsonl", SAMPLES)
+    # as ingested before the ingester wrote `sample_hashes`
+    db.execute("DELETE FROM sample_hashes")
+    db.execute("UPDATE config SET value = '5' WHERE key = 'schema_version'")
+    db.commit()
+
+    db = ingest(tmp_path, "again.jsonl", SAMPLES)
+    assert db.execute("SELECT COUNT(*) FROM documents").fetchone()[0] == 2 * len(SAMPLES)